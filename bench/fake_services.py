@@ -0,0 +1,95 @@
+"""本地替身服务: OpenAI 兼容的 chat/completions 接口和飞书 webhook
+
+返回固定格式的内容, 按配置的延迟响应, 并统计调用次数和请求体大小。
+"""
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+
+class FakeServices:
+    def __init__(self, host='127.0.0.1', port=3399, llm_latency=0.5, webhook_latency=0.05,
+                 tokens_per_second=0):
+        self.host = host
+        self.port = port
+        # 每次大模型调用的固定延迟, 以及按输出长度额外增加的延迟(0 表示不模拟)
+        self.llm_latency = llm_latency
+        self.tokens_per_second = tokens_per_second
+        self.webhook_latency = webhook_latency
+        self.llm_calls = 0
+        self.llm_prompt_chars = 0
+        self.webhook_calls = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.handle_chat)
+        app.router.add_post('/hook', self.handle_webhook)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self):
+        return {
+            'llm_calls': self.llm_calls,
+            'llm_prompt_chars': self.llm_prompt_chars,
+            'webhook_calls': self.webhook_calls
+        }
+
+    async def handle_chat(self, request):
+        body = await request.json()
+        prompt_chars = sum(len(message.get('content') or '') for message in body.get('messages', []))
+        self.llm_calls += 1
+        self.llm_prompt_chars += prompt_chars
+        content = (f"📋 今日群聊总结\n共收到 {prompt_chars} 个字符的输入。\n\n"
+                   f"💡 话题\n- 模拟话题\n\n👥 活跃\n- 模拟用户")
+        completion_tokens = len(content)
+        delay = self.llm_latency
+        if self.tokens_per_second:
+            delay += completion_tokens / self.tokens_per_second
+        usage = {
+            'prompt_tokens': prompt_chars,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_chars + completion_tokens
+        }
+
+        if body.get('stream'):
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+            for piece in pieces:
+                await asyncio.sleep(delay / len(pieces))
+                chunk = {
+                    'id': 'bench', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                    'model': body.get('model', ''),
+                    'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]
+                }
+                await response.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            await response.write(b'data: [DONE]\n\n')
+            return response
+
+        await asyncio.sleep(delay)
+        return web.json_response({
+            'id': 'bench', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                         'finish_reason': 'stop'}],
+            'usage': usage
+        })
+
+    async def handle_webhook(self, request):
+        await request.read()
+        self.webhook_calls += 1
+        await asyncio.sleep(self.webhook_latency)
+        return web.json_response({'code': 0, 'msg': 'success'})
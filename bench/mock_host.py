@@ -0,0 +1,84 @@
+"""模拟的 LangBot 宿主环境
+
+插件只能在 LangBot 中运行, 这里用最小的替身模块代替 pkg.* 包,
+并提供模拟的 APIHost / EventContext, 用于在 LangBot 之外驱动插件。
+"""
+import sys
+import time
+import types
+
+
+class FakeAPIHost:
+    """模拟的 APIHost, 插件目前只把它传给 BasePlugin"""
+
+
+class FakeBasePlugin:
+    def __init__(self, host):
+        self.host = host
+
+
+class Plain:
+    def __init__(self, text):
+        self.text = text
+
+
+class MessageChain(list):
+    pass
+
+
+class GroupNormalMessageReceived:
+    pass
+
+
+class FakeEventContext:
+    """模拟的群消息事件上下文, 记录插件的回复及回复耗时"""
+
+    def __init__(self, group_id, sender_id, text, group_name='', sender_name=''):
+        sender = types.SimpleNamespace(
+            member_name=sender_name,
+            group=types.SimpleNamespace(name=group_name)
+        )
+        self.event = types.SimpleNamespace(
+            launcher_id=group_id,
+            sender_id=sender_id,
+            text_message=text,
+            query=types.SimpleNamespace(message_event=types.SimpleNamespace(sender=sender))
+        )
+        self.created = time.perf_counter()
+        self.replies = []
+        self.prevented = False
+
+    def prevent_default(self):
+        self.prevented = True
+
+    async def reply(self, message_chain):
+        text = ''.join(getattr(item, 'text', '') for item in message_chain)
+        self.replies.append((time.perf_counter() - self.created, text))
+
+
+def install():
+    """把替身模块注册到 sys.modules, 需在导入 main 之前调用"""
+    if 'pkg.plugin.context' in sys.modules:
+        return
+
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        # 让 from ... import * 只导出这里列出的名字
+        mod.__all__ = list(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    module('pkg')
+    module('pkg.plugin')
+    module('pkg.platform')
+    module('pkg.provider')
+    module('pkg.plugin.context',
+           register=lambda **kwargs: (lambda cls: cls),
+           handler=lambda event: (lambda func: func),
+           BasePlugin=FakeBasePlugin,
+           APIHost=FakeAPIHost,
+           EventContext=FakeEventContext)
+    module('pkg.plugin.events', GroupNormalMessageReceived=GroupNormalMessageReceived)
+    module('pkg.platform.types', MessageChain=MessageChain, Plain=Plain)
+    module('pkg.provider.entities', Message=type('Message', (), {}))
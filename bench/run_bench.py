@@ -0,0 +1,397 @@
+"""群聊分析插件的离线性能测试
+
+在 LangBot 之外用模拟宿主驱动插件, 大模型和飞书接口由本地替身服务代替。
+测试项目:
+  ingest     以给定速率向 on_group_message 注入多群消息, 统计写入吞吐和单条处理耗时
+  commands   在不同大小的当日记录上测量 总结 / 看看 命令的耗时(首次、缓存命中、增量)
+  daily      测量 N 个群的 daily_summary 总耗时
+  endpoints  测量 /messages 和 /summaries 接口的响应时间
+
+结果以 JSON 输出, 便于在不同版本之间对比:
+  python bench/run_bench.py --output result.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import mock_host  # noqa: E402
+
+mock_host.install()
+
+import aiohttp  # noqa: E402
+import main  # noqa: E402
+from fake_services import FakeServices  # noqa: E402
+
+WORDS = ['今天', '大家', '这个', '版本', '问题', '已经', '修复', '了吗', '晚上', '一起', '开会',
+         '文档', '更新', '哈哈', '收到', '好的', '部署', '服务器', '日志', '需求', '周末', '吃饭',
+         'bug', 'PR', 'release', 'ok', '👍', '[图片]', '有人', '知道', '怎么', '配置']
+
+
+def percentiles(values):
+    """计算耗时列表的常用分位数(秒)"""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 6)
+
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 6),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(values[-1], 6)
+    }
+
+
+def random_text(rng):
+    return ''.join(rng.choice(WORDS) for _ in range(rng.randint(2, 20)))
+
+
+def make_rows(date, groups, users, count, rng):
+    """生成某天按时间排序的模拟消息行(按 LOG_HEADER 顺序)
+
+    时间都早于当前时刻, 保证测试中新发送的消息排在这些消息之后。
+    """
+    day = datetime.strptime(date, '%Y%m%d')
+    span = max(1, min(86400, int(time.time() - day.timestamp())))
+    seconds = sorted(rng.randrange(0, span) for _ in range(count))
+    rows = []
+    for second in seconds:
+        group = rng.randrange(groups)
+        user = rng.randrange(users)
+        timestamp = datetime.fromtimestamp(day.timestamp() + second).strftime('%Y-%m-%d %H:%M:%S')
+        text = random_text(rng)
+        raw = {'group_id': f'g{group}', 'sender_id': f'u{user}', 'message': text}
+        rows.append([timestamp, f'g{group}', f'群{group}', f'u{user}', f'用户{user}', text,
+                     json.dumps(raw, ensure_ascii=False)])
+    return rows
+
+
+def seed_store(data_dir, backend, rows):
+    """在插件启动前把模拟消息写入存储"""
+    if backend == 'sqlite':
+        store = main.SqliteMessageStore(os.path.join(data_dir, 'messages.db'))
+        store.write_rows_sync(rows)
+        store.executor.shutdown()
+    else:
+        store = main.CsvMessageStore(data_dir)
+        store.write_rows_sync(rows)
+        store.range_executor.shutdown()
+
+
+def storage_bytes(data_dir):
+    total = 0
+    for root, _, files in os.walk(data_dir):
+        for name in files:
+            if name.startswith('daily_') or name.startswith('messages.db'):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.services = FakeServices(port=args.port, llm_latency=args.llm_latency,
+                                     webhook_latency=args.webhook_latency,
+                                     tokens_per_second=args.tokens_per_second)
+        self.web_port = args.web_port
+        self.work_dir = tempfile.mkdtemp(prefix='chat_analyzer_bench_')
+        self.today = datetime.now().strftime('%Y%m%d')
+
+    def new_data_dir(self, name):
+        path = os.path.join(self.work_dir, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    async def start_plugin(self, data_dir):
+        """在指定数据目录中启动插件, 每个实例使用单独的Web端口"""
+        bench = self
+        overrides = dict(self.args.settings)
+        port = self.web_port
+        self.web_port += 1
+
+        class BenchPlugin(main.ChatAnalyzerPlugin):
+            def init_settings(self):
+                super().init_settings()
+                self.data_dir = data_dir
+                self.storage_backend = bench.args.backend
+                self.llm_base_url = f'{bench.services.base_url}/v1'
+                self.llm_api_key = 'bench'
+                self.llm_model = 'bench'
+                self.feishu_webhook_url = f'{bench.services.base_url}/hook'
+                self.web_port = port
+                self.llm_requests_per_minute = bench.args.llm_rpm
+                for key, value in overrides.items():
+                    setattr(self, key, value)
+
+        started = time.perf_counter()
+        plugin = BenchPlugin(mock_host.FakeAPIHost())
+        # 启动耗时包括后台导入记录和预热缓存
+        await plugin.store_ready.wait()
+        startup = time.perf_counter() - started
+        # 等待Web服务启动
+        await asyncio.sleep(0.3)
+        return plugin, startup
+
+    async def stop_plugin(self, plugin):
+        await plugin.destroy()
+
+    async def send(self, plugin, group_id, sender_id, text):
+        ctx = mock_host.FakeEventContext(group_id, sender_id, text, f'群{group_id}', f'用户{sender_id}')
+        started = time.perf_counter()
+        await plugin.on_group_message(ctx)
+        return time.perf_counter() - started, ctx
+
+    async def bench_ingest(self):
+        """按给定速率注入消息, 统计单条处理耗时和落盘吞吐"""
+        args = self.args
+        plugin, startup = await self.start_plugin(self.new_data_dir('ingest'))
+        latencies = []
+        interval = 1 / args.rate if args.rate else 0
+        started = time.perf_counter()
+        for i in range(args.messages):
+            if interval:
+                delay = started + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elapsed, _ = await self.send(plugin, f'g{self.rng.randrange(args.groups)}',
+                                         f'u{self.rng.randrange(args.users)}', random_text(self.rng))
+            latencies.append(elapsed)
+        accepted = time.perf_counter() - started
+        await plugin.ingest_writer.flush()
+        total = time.perf_counter() - started
+        result = {
+            'messages': args.messages,
+            'target_rate': args.rate,
+            'startup_seconds': round(startup, 6),
+            'accept_seconds': round(accepted, 6),
+            'total_seconds': round(total, 6),
+            'messages_per_second': round(args.messages / total, 1),
+            'handler_latency': percentiles(latencies),
+            'max_queue_depth': plugin.ingest_writer.max_depth,
+            'batches_written': plugin.ingest_writer.batches_written,
+            'storage_bytes': storage_bytes(plugin.data_dir)
+        }
+        await self.stop_plugin(plugin)
+        return result
+
+    async def bench_commands(self):
+        """在不同大小的当日记录上测量 总结 / 看看 的耗时"""
+        args = self.args
+        results = []
+        for size in args.sizes:
+            data_dir = self.new_data_dir(f'commands_{size}')
+            seed_store(data_dir, args.backend, make_rows(self.today, args.groups, args.users, size, self.rng))
+            plugin, startup = await self.start_plugin(data_dir)
+            result = {'messages': size, 'storage_bytes': storage_bytes(data_dir),
+                      'startup_seconds': round(startup, 6)}
+            calls = self.services.llm_calls
+
+            result['summary_cold'], _ = await self.send(plugin, 'g0', 'u0', '总结')
+            result['summary_cached'], _ = await self.send(plugin, 'g0', 'u0', '总结')
+            result['profile_cold'], _ = await self.send(plugin, 'g0', 'u0', '看看')
+            for _ in range(10):
+                await self.send(plugin, 'g0', 'u0', random_text(self.rng))
+            before_incremental = self.services.llm_calls
+            result['profile_incremental'], _ = await self.send(plugin, 'g0', 'u0', '看看')
+            # 增量更新必须真的把新消息合并进画像, 否则测到的只是缓存命中
+            assert self.services.llm_calls > before_incremental, '增量画像更新没有调用大模型'
+            result['llm_calls'] = self.services.llm_calls - calls
+            for key in ('summary_cold', 'summary_cached', 'profile_cold', 'profile_incremental'):
+                result[key] = round(result[key], 6)
+            results.append(result)
+            await self.stop_plugin(plugin)
+        return results
+
+    async def bench_daily(self):
+        """测量N个群的每日总结总耗时, 返回结果和插件(供接口测试继续使用)"""
+        args = self.args
+        data_dir = self.new_data_dir('daily')
+        rows = make_rows(self.today, args.daily_groups, args.users,
+                         args.daily_groups * args.daily_messages, self.rng)
+        seed_store(data_dir, args.backend, rows)
+        plugin, startup = await self.start_plugin(data_dir)
+        before = self.services.stats()
+        started = time.perf_counter()
+        await plugin.daily_summary()
+        elapsed = time.perf_counter() - started
+        # 推送由发件箱在后台完成, 等待全部送达
+        await asyncio.wait_for(plugin.feishu_outbox.join(), 600)
+        delivered = time.perf_counter() - started
+        after = self.services.stats()
+        result = {
+            'groups': args.daily_groups,
+            'messages': len(rows),
+            'startup_seconds': round(startup, 6),
+            'seconds': round(elapsed, 6),
+            'delivered_seconds': round(delivered, 6),
+            'llm_calls': after['llm_calls'] - before['llm_calls'],
+            'llm_prompt_chars': after['llm_prompt_chars'] - before['llm_prompt_chars'],
+            'webhook_calls': after['webhook_calls'] - before['webhook_calls']
+        }
+        return result, plugin
+
+    async def bench_endpoints(self, plugin):
+        """测量 /messages 和 /summaries 接口的响应时间"""
+        args = self.args
+        base = f'http://127.0.0.1:{plugin.web_port}'
+        auth = aiohttp.BasicAuth('bench', plugin.web_password)
+        endpoints = {
+            'messages_page': f'/messages?date={self.today}&limit={args.page_size}',
+            'messages_group_page': f'/messages?date={self.today}&group_id=g0&limit={args.page_size}',
+            'summaries_page': '/summaries?limit=50',
+            'status': '/status'
+        }
+        results = {}
+        async with aiohttp.ClientSession(auth=auth) as session:
+            for name, path in endpoints.items():
+                latencies = []
+                size = 0
+                for _ in range(args.requests):
+                    started = time.perf_counter()
+                    async with session.get(base + path) as response:
+                        body = await response.read()
+                        response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                    size = len(body)
+                results[name] = {'path': path, 'bytes': size, 'latency': percentiles(latencies)}
+
+            # 按游标翻完某个群当天的全部消息
+            started = time.perf_counter()
+            pages = rows = 0
+            cursor = ''
+            while True:
+                async with session.get(f'{base}/messages', params={
+                        'date': self.today, 'group_id': 'g0', 'limit': args.page_size, 'cursor': cursor}) as response:
+                    data = await response.json()
+                pages += 1
+                rows += len(data['messages'])
+                if not data['has_more']:
+                    break
+                cursor = data['next_cursor']
+            results['messages_group_full_scan'] = {
+                'pages': pages,
+                'rows': rows,
+                'seconds': round(time.perf_counter() - started, 6)
+            }
+        return results
+
+    async def run(self):
+        args = self.args
+        await self.services.start()
+        results = {}
+        try:
+            if 'ingest' in args.scenarios:
+                results['ingest'] = await self.bench_ingest()
+            if 'commands' in args.scenarios:
+                results['commands'] = await self.bench_commands()
+            if 'daily' in args.scenarios or 'endpoints' in args.scenarios:
+                daily, plugin = await self.bench_daily()
+                if 'daily' in args.scenarios:
+                    results['daily'] = daily
+                if 'endpoints' in args.scenarios:
+                    results['endpoints'] = await self.bench_endpoints(plugin)
+                await self.stop_plugin(plugin)
+        finally:
+            await self.services.close()
+            if not args.keep_data:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+        return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def parse_setting(text):
+    """解析 --set key=value, value 按JSON解析, 失败时作为字符串"""
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='群聊分析插件离线性能测试')
+    parser.add_argument('--scenarios', default='ingest,commands,daily,endpoints',
+                        type=lambda value: set(value.split(',')), help='要运行的测试, 逗号分隔')
+    parser.add_argument('--backend', default='csv', choices=['csv', 'sqlite'], help='消息存储后端')
+    parser.add_argument('--groups', type=int, default=10, help='模拟的群数量')
+    parser.add_argument('--users', type=int, default=50, help='每个群的模拟用户数量')
+    parser.add_argument('--messages', type=int, default=20000, help='ingest 测试注入的消息条数')
+    parser.add_argument('--rate', type=float, default=0, help='ingest 测试每秒注入的消息条数, 0 表示不限速')
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help='commands 测试的当日消息条数, 逗号分隔')
+    parser.add_argument('--daily-groups', type=int, default=20, help='daily 测试的群数量')
+    parser.add_argument('--daily-messages', type=int, default=2000, help='daily 测试每个群的消息条数')
+    parser.add_argument('--requests', type=int, default=20, help='endpoints 测试每个接口的请求次数')
+    parser.add_argument('--page-size', type=int, default=500, help='endpoints 测试 /messages 的每页条数')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='替身大模型接口的固定延迟(秒)')
+    parser.add_argument('--tokens-per-second', type=float, default=0, help='替身大模型的输出速度, 0 表示不模拟')
+    parser.add_argument('--llm-rpm', type=int, default=6000,
+                        help='插件的大模型每分钟请求数限制, 默认放宽以免限流掩盖其他耗时')
+    parser.add_argument('--webhook-latency', type=float, default=0.05, help='替身飞书接口的延迟(秒)')
+    parser.add_argument('--port', type=int, default=3399, help='替身服务端口')
+    parser.add_argument('--web-port', type=int, default=3310, help='插件Web服务的起始端口')
+    parser.add_argument('--set', dest='settings', action='append', default=[], type=parse_setting,
+                        metavar='KEY=VALUE', help='覆盖插件配置项, 可多次使用')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--output', help='结果JSON文件路径, 默认输出到标准输出')
+    parser.add_argument('--keep-data', action='store_true', help='保留测试数据目录')
+    return parser.parse_args(argv)
+
+
+def main_entry(argv=None):
+    args = parse_args(argv)
+    started = datetime.now()
+    # 插件的运行日志输出到标准错误, 标准输出只保留测试结果
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(Bench(args).run())
+    report = {
+        'started_at': started.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            key: sorted(value) if isinstance(value, set) else value
+            for key, value in vars(args).items() if key not in ('output', 'settings')
+        },
+        'settings': dict(args.settings),
+        'results': results
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"测试结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main_entry()
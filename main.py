@@ -4,15 +4,2860 @@ from pkg.platform.types import *
 from pkg.provider.entities import Message
 import csv
 import os
+import random
+import re
+import time
 from datetime import datetime, timedelta
-import traceback
 import json
 import asyncio
+import io
+import gzip
+import itertools
+import bisect
+import threading
+import logging
+import logging.handlers
+import queue
+import sys
 import aiofiles
 import aiohttp
 import openai
 from aiohttp import web
 import base64
+import shutil
+from urllib.parse import quote
+import hashlib
+import html
+import math
+import sqlite3
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from email.utils import formatdate
+
+try:
+    import brotli
+except ImportError:
+    # 可选依赖, 没有安装时只使用 gzip 压缩响应
+    brotli = None
+
+try:
+    import tiktoken
+except ImportError:
+    # 可选依赖, 配置 prompt_tokenizer 后用于精确计算token数
+    tiktoken = None
+
+# 每日消息记录的CSV表头
+LOG_HEADER = [
+    'timestamp',
+    'group_id',
+    'group_name',
+    'sender_id',
+    'sender_name',
+    'text_message',
+    'raw_data'
+]
+
+# 消息记录中除 raw_data 外的字段
+MESSAGE_COLUMNS = LOG_HEADER[:6]
+
+# 总结记录的CSV表头
+SUMMARY_HEADER = [
+    'timestamp',
+    'group_id',
+    'summary_type',  # auto/manual/profile
+    'content',
+    'source_date'
+]
+
+
+# 总结失败时的回复, 这些结果不会被缓存
+LLM_FAILED_REPLY = "AI未能生成有效响应,请稍后重试"
+SUMMARY_ERROR_REPLY = "AI总结过程中发生错误"
+
+# 群聊总结的系统提示词
+DAILY_SYSTEM_PROMPT = """你是一个群聊分析助手，负责总结群聊内容。请按以下要求输出：
+1. 不要使用markdown语法
+2. 使用适当的emoji表情
+3. 分段输出，每段之间空一行
+4. 按以下结构深入分析内容：
+
+📋 今日话题概述
+- 详细列举主要讨论话题
+- 分析话题的发展脉络
+- 总结核心议题走向
+
+💡 重点讨论内容
+- 深入分析各话题的讨论要点
+- 总结群成员的主要观点分布
+- 提炼有价值的信息亮点
+
+🌈 群聊氛围分析
+- 整体情感倾向分析
+- 互动热度和活跃度评估
+- 群组文化特征观察
+- 特殊事件或话题影响
+
+👥 成员互动特点
+- 成员参与度分布
+- 互动模式和规律
+- 意见领袖表现
+- 群体凝聚力表现
+
+请确保：
+- 每个部分都有充分详实的内容
+- 分析要有深度和洞察
+- 语言自然流畅
+- 结构清晰易读"""
+
+# 附在群聊记录之后的活跃统计
+ACTIVITY_STATS_PROMPT = "\n以下是根据全部消息统计的活跃数据, 分析👥 成员互动特点时请以这些数据为准:\n{stats}\n"
+
+# 用户画像的系统提示词
+PROFILE_SYSTEM_PROMPT = """你是一个群聊分析助手，负责分析用户画像。请按以下要求输出：
+1. 不要使用markdown语法
+2. 使用适当的emoji表情
+3. 分段输出，每段之间空一行
+4. 按以下结构深入分析用户特征：
+
+🧠 思维特征分析
+- 思维方式和逻辑特点
+- 观点形成和表达方式
+- 问题解决倾向
+- 认知风格特点
+
+💭 性格特征画像
+- 性格特点全面分析
+- 情感表达特征
+- 核心价值观表现
+- 行为模式特点
+
+💬 表达风格特征
+- 语言表达特点
+- 用词和表达习惯
+- 情感表达方式
+- 沟通策略分析
+
+🎯 兴趣和专业领域
+- 主要关注话题
+- 专业知识领域
+- 兴趣爱好表现
+- 观点倾向分析
+
+🤝 社交互动模式
+- 群内角色定位
+- 社交风格特点
+- 互动习惯分析
+- 人际关系处理
+
+请确保：
+- 分析要全面且深入
+- 举例说明具体表现
+- 注意分析的逻辑性
+- 保持客观专业态度"""
+
+# 根据新发言更新已有用户画像时的提示
+PROFILE_MERGE_PROMPT = "以下是该用户已有的画像:\n\n{profile}\n\n以下是该用户之后的新发言, 请结合新发言更新画像, 输出完整的新画像:\n\n"
+
+# 分块总结时, 总结单个片段的系统提示词
+CHUNK_SYSTEM_PROMPT = """你是一个群聊分析助手，负责提炼一段群聊记录的要点，供之后汇总全天内容使用。请按以下要求输出：
+1. 不要使用markdown语法
+2. 只输出要点，语言简洁，不要寒暄
+3. 依次说明：
+- 讨论了哪些话题，各话题的主要观点和结论
+- 有价值的信息、链接或决定
+- 聊天氛围和情绪变化
+- 哪些成员发言活跃，谁在引导话题，成员之间如何互动"""
+
+# 分块总结时, 总结单个片段的用户提示词前缀
+CHUNK_USER_PROMPT = "请提炼以下群聊记录片段的要点:\n\n"
+
+# 分块要点缓存的版本, 修改分块总结的提示词、抽样或分块方式时递增, 使旧缓存失效
+WINDOW_CACHE_VERSION = 3
+
+# 分块总结时, 合并多个片段要点的系统提示词
+MERGE_SYSTEM_PROMPT = """你是一个群聊分析助手，负责把按时间顺序排列的多段群聊要点合并为一份要点。请按以下要求输出：
+1. 不要使用markdown语法
+2. 只输出要点，语言简洁，不要寒暄
+3. 合并重复的话题，保留话题的发展脉络、主要观点、氛围变化和成员互动情况"""
+
+
+# 日志分类: 插件主流程、消息写入、存储、大模型调用、Web服务
+logger = logging.getLogger('chat_analyzer')
+ingest_logger = logger.getChild('ingest')
+storage_logger = logger.getChild('storage')
+llm_logger = logger.getChild('llm')
+web_logger = logger.getChild('web')
+
+
+class SamplingFilter(logging.Filter):
+    """按日志分类抽样: 每 N 条只保留一条, WARNING 及以上级别总是保留"""
+
+    def __init__(self, sample_every):
+        super().__init__()
+        # {分类(如 'ingest'): N}
+        self.sample_every = dict(sample_every or {})
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = record.name.rpartition('.')[2] if record.name != logger.name else ''
+        every = self.sample_every.get(category, 1)
+        if every <= 1:
+            return True
+        counter = self._counters.get(category)
+        if counter is None:
+            counter = self._counters.setdefault(category, itertools.count())
+        return next(counter) % every == 0
+
+
+class TruncatingFilter(logging.Filter):
+    """截断过长的日志内容(如完整的提示词), 异常堆栈不截断"""
+
+    def __init__(self, max_length):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record):
+        if not self.max_length:
+            return True
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            record.msg = f"{message[:self.max_length]}...(共 {len(message)} 字符)"
+            record.args = None
+        return True
+
+
+_log_listener = None
+
+
+def setup_logging(level='INFO', sample_every=None, max_length=2000):
+    """配置插件日志: 记录经队列交给后台线程输出, 事件循环中不做任何IO
+
+    重复调用时会替换之前的配置。
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_every))
+    queue_handler.addFilter(TruncatingFilter(max_length))
+
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    _log_listener = logging.handlers.QueueListener(log_queue, output)
+    _log_listener.start()
+    return _log_listener
+
+
+def stop_logging(listener=None):
+    """停止后台日志线程, 输出队列中剩余的日志
+
+    指定 listener 时只有它仍是当前配置才停止, 避免旧的插件实例停掉新实例的日志。
+    """
+    global _log_listener
+    if listener is not None and listener is not _log_listener:
+        return
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+
+
+_token_encoding = None
+
+
+def configure_tokenizer(name):
+    """设置计算token数使用的 tiktoken 编码(如 cl100k_base), 为空或加载失败时使用估算值"""
+    global _token_encoding
+    _token_encoding = None
+    if not name:
+        return
+    if tiktoken is None:
+        logger.warning("未安装 tiktoken, token 数使用估算值")
+        return
+    try:
+        _token_encoding = tiktoken.get_encoding(name)
+    except Exception:
+        logger.warning("加载 tiktoken 编码 %s 失败, token 数使用估算值", name, exc_info=True)
+
+
+def estimate_tokens(text):
+    """计算文本的token数: 配置了 tiktoken 编码时精确计算, 否则粗略估算(中日韩字符按每字1个, 其余按每4个字符1个)"""
+    if _token_encoding is not None:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def is_cacheable_reply(reply):
+    """总结失败的回复不缓存"""
+    return reply not in (LLM_FAILED_REPLY, SUMMARY_ERROR_REPLY)
+
+
+def split_into_chunks(lines, chunk_tokens):
+    """按token预算把若干行切分成块, 单行超过预算时独占一块"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# 图片、表情等非文字消息在平台上的占位文本, 如 [图片]、[动画表情]
+MEDIA_PATTERN = re.compile(r'^(?:\[[^\[\]\s]{1,8}\]\s*)+$')
+# 连续出现三次以上的同一字符, 如 "哈哈哈哈"
+REPEAT_PATTERN = re.compile(r'(.)\1{2,}')
+PUNCTUATION_PATTERN = re.compile(r'[\W_]+')
+
+
+def normalize_text(text):
+    """判断重复消息用的规范化文本: 忽略大小写、空白、标点和叠字的次数"""
+    text = REPEAT_PATTERN.sub(r'\1\1', text.lower())
+    return PUNCTUATION_PATTERN.sub('', text) or text.strip()
+
+
+def short_sender(msg, max_chars=8):
+    """提示词中的发送者: 昵称过长时保留首尾, 没有昵称时用ID的后四位"""
+    name = msg.get('sender_name') or ''
+    if name:
+        return name if len(name) <= max_chars else name[:max_chars - 3] + '…' + name[-2:]
+    sender_id = msg.get('sender_id') or ''
+    return f'用户{sender_id[-4:]}' if sender_id else '未知用户'
+
+
+def compact_message_lines(messages, budget=None, max_chars=300, name_max_chars=8,
+                          dedup_minutes=10, merge_minutes=3):
+    """把按时间排序的消息压缩为提示词中的行(每行以换行结尾)
+
+    - 时间只保留到分钟, 与上一行相同时省略; 消息跨天时插入日期行
+    - dedup_minutes 分钟内重复的消息(忽略标点、大小写和叠字)以及图片、表情等
+      占位消息合并到第一次出现的位置, 记为 "×次数(人数)"
+    - 同一人 merge_minutes 分钟内的连续消息合并为一行, 单条消息超过 max_chars 字时截断
+    - 指定 budget 时从最新的消息开始保留, 超出预算的较早消息省略
+    """
+    entries = []
+    recent = OrderedDict()
+    for msg in messages:
+        timestamp = msg.get('timestamp') or ''
+        text = (msg.get('text_message') or '').strip() or '[非文字消息]'
+        sender_id = msg.get('sender_id') or ''
+        try:
+            minute = int(timestamp[11:13]) * 60 + int(timestamp[14:16])
+        except ValueError:
+            minute = 0
+        # 最近出现过的消息按最后出现的时间排列, 去掉超出时间窗口的
+        while recent:
+            oldest = next(iter(recent.values()))
+            if oldest['date'] == timestamp[:10] and minute - oldest['last_minute'] <= dedup_minutes:
+                break
+            recent.popitem(last=False)
+        key = ('media' if MEDIA_PATTERN.match(text) else 'text', normalize_text(text))
+        part = recent.get(key)
+        if part is not None:
+            part['count'] += 1
+            part['senders'].add(sender_id)
+            part['last_minute'] = minute
+            recent.move_to_end(key)
+            continue
+        if len(text) > max_chars:
+            text = text[:max_chars] + '…'
+        part = {'text': text, 'count': 1, 'senders': {sender_id}, 'date': timestamp[:10], 'last_minute': minute}
+        recent[key] = part
+        last = entries[-1] if entries else None
+        if (last is not None and last['sender_id'] == sender_id and last['date'] == timestamp[:10]
+                and minute - last['minute'] <= merge_minutes):
+            last['parts'].append(part)
+            continue
+        entries.append({
+            'date': timestamp[:10],
+            'minute': minute,
+            'time': timestamp[11:16] or '未知时间',
+            'sender_id': sender_id,
+            'sender': short_sender(msg, name_max_chars),
+            'parts': [part]
+        })
+
+    multi_day = len({entry['date'] for entry in entries}) > 1
+
+    def format_entry(entry, prefix):
+        texts = []
+        for part in entry['parts']:
+            text = part['text']
+            if part['count'] > 1:
+                text += f" ×{part['count']}"
+                if len(part['senders']) > 1:
+                    text += f"({len(part['senders'])}人)"
+            texts.append(text)
+        return f"{prefix}{entry['sender']}: {' / '.join(texts)}\n"
+
+    def render(selected):
+        lines = []
+        last_date = last_time = None
+        for entry in selected:
+            if multi_day and entry['date'] != last_date:
+                lines.append(f"== {entry['date']} ==\n")
+                last_time = None
+            prefix = f"{entry['time']} " if entry['time'] != last_time else ''
+            last_date, last_time = entry['date'], entry['time']
+            lines.append(format_entry(entry, prefix))
+        return lines
+
+    lines = render(entries)
+    if budget is None or sum(estimate_tokens(line) for line in lines) <= budget:
+        return lines
+    # 超出预算时从最新的一段往前累计(每段按带时间计算, 每天另加一行日期), 再重新生成保留部分的时间和日期
+    start = len(entries)
+    tokens = 0
+    run_date = None
+    for entry in reversed(entries):
+        tokens += estimate_tokens(format_entry(entry, f"{entry['time']} "))
+        if multi_day and entry['date'] != run_date:
+            tokens += estimate_tokens(f"== {entry['date']} ==\n")
+            run_date = entry['date']
+        if tokens > budget and start < len(entries):
+            break
+        start -= 1
+    return [f"(更早的 {start} 段消息已省略)\n"] + render(entries[start:])
+
+
+class Metric:
+    """Prometheus 指标的基类, 按标签值分别记录, 可在任意线程中更新"""
+
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in pairs) + '}'
+
+    def collect(self):
+        """返回指标的文本格式行"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{self._format_labels(key)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的数值"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """耗时等数值的分布, 按上界累计计数"""
+
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 各区间的计数, 最后一个为超过最大上界的部分; 以及总和与总数
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{self.name}_bucket{self._format_labels(key, ("le", le))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表, 按 Prometheus 文本格式输出全部指标"""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内的全部指标, 由 /metrics 接口输出
+METRICS = MetricsRegistry()
+INGEST_MESSAGES = METRICS.counter(
+    'chat_analyzer_ingest_messages_total', '收到并加入写入队列的群消息条数')
+INGEST_SECONDS = METRICS.histogram(
+    'chat_analyzer_ingest_seconds', '处理一条普通群消息(入队、更新缓存和目录)的耗时',
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+INGEST_BATCH_SECONDS = METRICS.histogram(
+    'chat_analyzer_ingest_batch_seconds', '批量写入一批消息到存储的耗时')
+INGEST_ROWS_WRITTEN = METRICS.counter(
+    'chat_analyzer_ingest_rows_written_total', '写入存储的消息条数')
+HISTORY_READS = METRICS.counter(
+    'chat_analyzer_history_reads_total', '历史消息读取次数', ['reader', 'source'])
+HISTORY_READ_SECONDS = METRICS.histogram(
+    'chat_analyzer_history_read_seconds', '历史消息读取耗时', ['reader'])
+HISTORY_ROWS_RETURNED = METRICS.counter(
+    'chat_analyzer_history_rows_returned_total', '历史消息读取返回的消息条数', ['reader'])
+HISTORY_ROWS_SCANNED = METRICS.counter(
+    'chat_analyzer_history_rows_scanned_total', '读取历史消息时从存储中解析的消息条数', ['store'])
+ARCHIVE_BLOCKS = METRICS.counter(
+    'chat_analyzer_archive_blocks_total', '读取归档时解压和跳过的块数', ['result'])
+LLM_REQUESTS = METRICS.counter(
+    'chat_analyzer_llm_requests_total', '大模型调用次数(含重试后最终结果)', ['status'])
+LLM_RETRIES = METRICS.counter(
+    'chat_analyzer_llm_retries_total', '大模型调用失败后的重试次数')
+LLM_SECONDS = METRICS.histogram(
+    'chat_analyzer_llm_seconds', '单次大模型请求的耗时(不含限流等待)', ['status'])
+LLM_TOKENS = METRICS.counter(
+    'chat_analyzer_llm_tokens_total', '大模型接口返回的token用量', ['type'])
+SUMMARIZE_SECONDS = METRICS.histogram(
+    'chat_analyzer_summarize_seconds', 'summarize_messages 的总耗时(含限流和重试)', ['prompt_type'])
+FEISHU_POSTS = METRICS.counter(
+    'chat_analyzer_feishu_posts_total', '飞书推送次数', ['status'])
+FEISHU_SECONDS = METRICS.histogram(
+    'chat_analyzer_feishu_seconds', '飞书推送耗时')
+FEISHU_OUTBOX_DEPTH = METRICS.gauge(
+    'chat_analyzer_feishu_outbox_depth', '发件箱中等待推送到飞书的通知条数')
+FEISHU_DELIVERY_SECONDS = METRICS.histogram(
+    'chat_analyzer_feishu_delivery_seconds', '通知从进入发件箱到推送成功的耗时(含排队和重试)',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400))
+FEISHU_DEAD_LETTERS = METRICS.counter(
+    'chat_analyzer_feishu_dead_letters_total', '超过最大重试次数后移入 outbox/failed 的通知条数')
+HTTP_REQUESTS = METRICS.counter(
+    'chat_analyzer_http_requests_total', 'Web接口请求次数', ['handler', 'status'])
+HTTP_SECONDS = METRICS.histogram(
+    'chat_analyzer_http_request_seconds', 'Web接口处理耗时(流式响应含发送时间)', ['handler'])
+INGEST_QUEUE_DEPTH = METRICS.gauge(
+    'chat_analyzer_ingest_queue_depth', '等待写入存储的消息条数')
+TODAY_ROWS = METRICS.gauge(
+    'chat_analyzer_today_rows', '今天已记录的消息条数')
+DATA_DIR_BYTES = METRICS.gauge(
+    'chat_analyzer_data_dir_bytes', '数据目录占用的字节数(定期统计)')
+
+
+def observe_history_read(reader, source, count, started):
+    """记录一次历史消息读取: 来源(缓存/存储)、返回条数和耗时"""
+    HISTORY_READS.inc(reader=reader, source=source)
+    HISTORY_ROWS_RETURNED.inc(count, reader=reader)
+    HISTORY_READ_SECONDS.observe(time.perf_counter() - started, reader=reader)
+
+
+class RateLimiter:
+    """按每分钟请求数和token数限流的令牌桶
+
+    burst 为最多连续发出的请求数, 默认等于每分钟请求数; tokens_per_minute 为 None 时不限制token数。
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None, burst=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst = burst or requests_per_minute
+        self._requests = float(self.burst)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.burst,
+                             self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute,
+                               self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens=0):
+        """等待直到可以发出一个消耗 tokens 个token的请求"""
+        # 单个请求超过桶容量时按桶容量计, 避免永远等待
+        tokens = min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = (1 - self._requests) * 60 / self.requests_per_minute
+                if tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                await asyncio.sleep(max(wait, 0.01))
+
+
+FEISHU_RATE_LIMITED_CODE = 11232
+
+
+def feishu_payload(items):
+    """构造飞书webhook消息: 单条通知用纯文本, 多条通知合并为一张富文本卡片"""
+    if len(items) == 1:
+        item = items[0]
+        return {"msg_type": "text", "content": {"text": f"{item['title']}:\n{item['text']}"}}
+    content = []
+    for item in items:
+        if content:
+            content.append([{"tag": "text", "text": ""}])
+        content.append([{"tag": "text", "text": f"{item['title']}:"}])
+        content.extend([{"tag": "text", "text": line}] for line in item['text'].split('\n'))
+    return {
+        "msg_type": "post",
+        "content": {"post": {"zh_cn": {"title": f"每日群聊总结({len(items)} 个群)", "content": content}}}
+    }
+
+
+class FeishuOutbox:
+    """等待推送到飞书的通知发件箱
+
+    每条通知是 outbox/ 下的一个 JSON 文件, 推送成功后删除。后台任务按进入发件箱的顺序推送,
+    batch_size 大于 1 时把同时待发的多条通知合并为一张卡片(不超过 batch_max_bytes 字节)。
+    失败后按指数退避重试, 下次重试时间和已重试次数写在文件中, 重启后继续; 超过 max_attempts
+    次的通知移到 outbox/failed/ 保留。send 为协程函数, 接收webhook消息体,
+    返回 (是否成功, 被限流时需要暂停的秒数)。
+    """
+
+    def __init__(self, outbox_dir, send, batch_size=1, batch_delay=10, batch_max_bytes=18000,
+                 max_attempts=20, retry_base_delay=5, retry_max_delay=1800):
+        self.outbox_dir = outbox_dir
+        self.failed_dir = os.path.join(outbox_dir, 'failed')
+        self.send = send
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.batch_max_bytes = batch_max_bytes
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+        os.makedirs(self.failed_dir, exist_ok=True)
+        self._items = {}
+        self._seq = 0
+        self._paused_until = 0
+        self._send_now = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+        # 统计信息
+        self.delivered = 0
+        self.posts = 0
+        self.dead_letters = len(os.listdir(self.failed_dir))
+        self.last_error = None
+        self._load()
+
+    @property
+    def depth(self):
+        """等待推送的通知条数"""
+        return len(self._items)
+
+    def path(self, item_id):
+        return os.path.join(self.outbox_dir, f'{item_id}.json')
+
+    def _load(self):
+        """读取上次运行时没有推送成功的通知"""
+        for name in sorted(os.listdir(self.outbox_dir)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.outbox_dir, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    item = json.load(f)
+                self._items[item['id']] = item
+            except (OSError, ValueError, KeyError):
+                logger.exception("读取发件箱中的通知 %s 出错, 已移到 failed", name)
+                os.replace(path, os.path.join(self.failed_dir, name))
+        FEISHU_OUTBOX_DEPTH.set(len(self._items))
+        if self._items:
+            logger.info("发件箱中有 %d 条尚未推送的通知", len(self._items))
+
+    def _save(self, item):
+        tmp_path = self.path(item['id']) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(item, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path(item['id']))
+
+    def put(self, title, text):
+        """把一条通知写入发件箱, 由后台任务推送"""
+        now = time.time()
+        self._seq += 1
+        item = {
+            'id': f'{int(now * 1000):013d}_{self._seq:06d}',
+            'title': title,
+            'text': text,
+            'created': now,
+            'attempts': 0,
+            'next_attempt': now,
+            'last_error': None
+        }
+        self._save(item)
+        self._items[item['id']] = item
+        FEISHU_OUTBOX_DEPTH.set(len(self._items))
+        self._wakeup.set()
+        return item['id']
+
+    def send_now(self):
+        """不再等待凑满一批, 立即推送当前待发的通知(如每日总结全部生成之后)"""
+        self._send_now = True
+        self._wakeup.set()
+
+    def start(self):
+        """启动后台推送任务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        """停止后台推送任务, 未推送的通知留在磁盘上, 下次启动后继续"""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def join(self):
+        """等待发件箱中的通知全部推送完成或移入 failed"""
+        while self._items:
+            await asyncio.sleep(0.05)
+
+    def _next_batch(self, now):
+        """取出现在应该推送的一批通知, 以及没有可推送的通知时需要等待的秒数"""
+        if now < self._paused_until:
+            return [], self._paused_until - now
+        due = sorted((item for item in self._items.values() if item['next_attempt'] <= now),
+                     key=lambda item: item['id'])
+        if not due:
+            if not self._items:
+                return [], None
+            return [], min(item['next_attempt'] for item in self._items.values()) - now
+        if self.batch_size > 1 and len(due) < self.batch_size and not self._send_now:
+            # 等一会儿, 让同时生成的通知合并到一张卡片中
+            wait = due[0]['next_attempt'] + self.batch_delay - now
+            if due[0]['attempts'] == 0 and wait > 0:
+                return [], wait
+        batch = due[:1]
+        for item in due[1:self.batch_size]:
+            size = len(json.dumps(feishu_payload(batch + [item]), ensure_ascii=False).encode('utf-8'))
+            if size > self.batch_max_bytes:
+                break
+            batch.append(item)
+        if len(batch) == len(due):
+            self._send_now = False
+        return batch, 0
+
+    async def _run(self):
+        while not self._closed:
+            batch, wait = self._next_batch(time.time())
+            if not batch:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            try:
+                await self._deliver(batch)
+            except Exception:
+                logger.exception("推送发件箱中的通知出错")
+                await asyncio.sleep(1)
+
+    async def _deliver(self, batch):
+        """推送一批通知, 成功后删除文件, 失败时安排重试"""
+        ok, pause = await self.send(feishu_payload(batch))
+        self.posts += 1
+        now = time.time()
+        if ok:
+            for item in batch:
+                del self._items[item['id']]
+                try:
+                    os.remove(self.path(item['id']))
+                except FileNotFoundError:
+                    pass
+                FEISHU_DELIVERY_SECONDS.observe(now - item['created'])
+            self.delivered += len(batch)
+            FEISHU_OUTBOX_DEPTH.set(len(self._items))
+            return
+
+        if pause:
+            # 被飞书限流: 暂停全部推送, 不计入重试次数
+            self._paused_until = now + pause
+            self.last_error = f'限流, 暂停 {pause} 秒'
+            logger.warning("飞书推送被限流, 暂停 %s 秒", pause)
+            return
+        self.last_error = datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ' 推送失败'
+        for item in batch:
+            item['attempts'] += 1
+            item['last_error'] = self.last_error
+            if item['attempts'] >= self.max_attempts:
+                del self._items[item['id']]
+                os.replace(self.path(item['id']), os.path.join(self.failed_dir, f"{item['id']}.json"))
+                self.dead_letters += 1
+                FEISHU_DEAD_LETTERS.inc()
+                logger.error("通知 %s 推送 %d 次仍失败, 已移到 %s",
+                             item['title'], item['attempts'], self.failed_dir)
+                continue
+            delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (item['attempts'] - 1))
+            item['next_attempt'] = now + delay * random.uniform(0.5, 1)
+            self._save(item)
+        FEISHU_OUTBOX_DEPTH.set(len(self._items))
+
+    def stats(self):
+        return {
+            'pending': len(self._items),
+            'delivered': self.delivered,
+            'posts': self.posts,
+            'dead_letters': self.dead_letters,
+            'last_error': self.last_error
+        }
+
+
+class IngestWriter:
+    """消息批量写入器
+
+    消息先进入内存缓冲区, 由后台任务按条数或时间阈值批量写入消息存储。
+    """
+
+    def __init__(self, store, batch_size=200, flush_interval=0.5, max_pending=10000):
+        # store: 消息存储后端, 见 CsvMessageStore / SqliteMessageStore
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._buffer = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+        # 统计信息
+        self.rows_written = 0
+        self.batches_written = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        """当前等待写入的消息条数"""
+        return len(self._buffer)
+
+    def start(self):
+        """启动后台刷新任务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, row):
+        """加入一行待写入的消息(按 LOG_HEADER 顺序), 缓冲区积压过多时等待落盘"""
+        self._buffer.append(row)
+        depth = len(self._buffer)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if depth >= self.max_pending:
+            ingest_logger.warning("写入队列积压 %d 条, 等待落盘", depth)
+            await self.flush()
+        elif depth >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        """按时间或条数阈值循环刷新"""
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                ingest_logger.exception("批量写入消息出错")
+
+    async def flush(self):
+        """把缓冲区中的消息全部写入存储"""
+        async with self._lock:
+            await self._write_buffer()
+
+    @asynccontextmanager
+    async def paused(self):
+        """写入缓冲区中的消息, 并在退出之前暂停落盘(如归档某天的文件时)"""
+        async with self._lock:
+            await self._write_buffer()
+            yield
+
+    async def _write_buffer(self):
+        while self._buffer:
+            batch = self._buffer[:self.batch_size]
+            started = time.perf_counter()
+            await self.store.write_rows(batch)
+            # 写入成功后才移出缓冲区, 写入出错时这批消息留到下次重试
+            del self._buffer[:len(batch)]
+            INGEST_BATCH_SECONDS.observe(time.perf_counter() - started)
+            INGEST_ROWS_WRITTEN.inc(len(batch))
+            self.rows_written += len(batch)
+            self.batches_written += 1
+
+    async def close(self):
+        """通知后台任务退出并等待正在进行的写入完成, 然后写入剩余消息"""
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        finally:
+            await self.store.close()
+
+
+def row_date(timestamp):
+    """从 'YYYY-MM-DD HH:MM:SS' 格式的时间戳中取出日期(YYYYMMDD)"""
+    return timestamp[:10].replace('-', '')
+
+
+def check_date(value):
+    """校验 YYYYMMDD 格式的日期, 格式错误时抛出 ValueError"""
+    if len(value) != 8 or not value.isdigit():
+        raise ValueError(f'无效的日期: {value}')
+    datetime.strptime(value, '%Y%m%d')
+    return value
+
+
+def date_range(start_date, end_date):
+    """列出 start_date 到 end_date(含两端, YYYYMMDD)之间的日期"""
+    dates = []
+    day = datetime.strptime(start_date, '%Y%m%d')
+    last = datetime.strptime(end_date, '%Y%m%d')
+    while day <= last:
+        dates.append(day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+    return dates
+
+
+class DailyLogArchive:
+    """已结束日期的消息记录压缩归档
+
+    每天一个 archive/daily_YYYYMMDD.csv.gz 文件, 由若干独立的 gzip 块顺序拼接而成,
+    每块包含固定条数的消息(去掉冗余的 raw_data 列)。旁边的 daily_YYYYMMDD.idx.json
+    记录每块的偏移、长度、条数、首尾时间和出现的群, 读取时只解压需要的块。
+    """
+
+    def __init__(self, data_dir, block_rows=2000, compress_level=6):
+        self.data_dir = data_dir
+        self.archive_dir = os.path.join(data_dir, 'archive')
+        self.block_rows = block_rows
+        self.compress_level = compress_level
+        self._indexes = {}
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+    def archive_path(self, date):
+        return os.path.join(self.archive_dir, f'daily_{date}.csv.gz')
+
+    def index_path(self, date):
+        return os.path.join(self.archive_dir, f'daily_{date}.idx.json')
+
+    def has(self, date):
+        return os.path.exists(self.index_path(date))
+
+    def list_dates(self):
+        """列出已归档的日期(升序)"""
+        dates = []
+        for name in os.listdir(self.archive_dir):
+            if name.startswith('daily_') and name.endswith('.idx.json'):
+                dates.append(name[len('daily_'):-len('.idx.json')])
+        return sorted(dates)
+
+    def pending_dates(self, before_date):
+        """列出 before_date 之前还没有归档的原始CSV日期"""
+        dates = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith('daily_') and name.endswith('.csv'):
+                date = name[len('daily_'):-len('.csv')]
+                if date < before_date:
+                    dates.append(date)
+        return sorted(dates)
+
+    def load_index(self, date):
+        """读取某天的块索引, 按文件修改时间缓存"""
+        path = self.index_path(date)
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        cached = self._indexes.get(date)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self._indexes[date] = (mtime, index)
+        return index
+
+    def iter_rows(self, date, start=0, group_id=None, sender_id=None, before=None, after=None):
+        """从第 start 条开始读取某天归档的消息(同步生成器)
+
+        生成 (消息, 已读条数), 按群和时间范围跳过不相关的块。
+        """
+        index = self.load_index(date)
+        if index is None:
+            return
+        columns = index['columns']
+        row_number = 0
+        blocks_read = rows_scanned = 0
+        try:
+            with open(self.archive_path(date), 'rb') as f:
+                for block in index['blocks']:
+                    block_start = row_number
+                    row_number += block['rows']
+                    if row_number <= start:
+                        continue
+                    if before and block['first'] >= before:
+                        return
+                    if after and block['last'] <= after:
+                        continue
+                    if group_id and group_id not in block['groups']:
+                        continue
+                    f.seek(block['offset'])
+                    data = gzip.decompress(f.read(block['length'])).decode('utf-8')
+                    blocks_read += 1
+                    for number, values in enumerate(csv.reader(io.StringIO(data, newline='')), block_start + 1):
+                        if number <= start:
+                            continue
+                        rows_scanned += 1
+                        row = dict(zip(columns, values))
+                        timestamp = row['timestamp']
+                        if before and timestamp >= before:
+                            return
+                        if after and timestamp <= after:
+                            continue
+                        if group_id and row['group_id'] != group_id:
+                            continue
+                        if sender_id and row['sender_id'] != sender_id:
+                            continue
+                        yield row, number
+        finally:
+            ARCHIVE_BLOCKS.inc(blocks_read, result='read')
+            ARCHIVE_BLOCKS.inc(len(index['blocks']) - blocks_read, result='skipped')
+            HISTORY_ROWS_SCANNED.inc(rows_scanned, store='archive')
+
+    def compact(self, date):
+        """把某天的原始CSV压缩进归档并删除原文件, 返回压缩统计
+
+        已有归档时(例如归档后又写入了当天的消息)把新消息追加合并进去。
+        """
+        csv_path = os.path.join(self.data_dir, f'daily_{date}.csv')
+        old_index = self.load_index(date)
+        raw_size = os.path.getsize(csv_path) + (old_index['raw_size'] if old_index else 0)
+        rows = [[row[column] for column in MESSAGE_COLUMNS] for row, _ in self.iter_rows(date)]
+        with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                rows.append([row.get(column) or '' for column in MESSAGE_COLUMNS])
+
+        blocks = []
+        tmp_archive = self.archive_path(date) + '.tmp'
+        with open(tmp_archive, 'wb') as f:
+            for start in range(0, len(rows), self.block_rows):
+                block_rows = rows[start:start + self.block_rows]
+                buf = io.StringIO()
+                csv.writer(buf).writerows(block_rows)
+                data = gzip.compress(buf.getvalue().encode('utf-8'), self.compress_level, mtime=0)
+                blocks.append({
+                    'offset': f.tell(),
+                    'length': len(data),
+                    'rows': len(block_rows),
+                    'first': min(row[0] for row in block_rows),
+                    'last': max(row[0] for row in block_rows),
+                    'groups': sorted({row[1] for row in block_rows})
+                })
+                f.write(data)
+            size = f.tell()
+        index = {
+            'columns': MESSAGE_COLUMNS,
+            'rows': len(rows),
+            'raw_size': raw_size,
+            'size': size,
+            'blocks': blocks
+        }
+        tmp_index = self.index_path(date) + '.tmp'
+        with open(tmp_index, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_archive, self.archive_path(date))
+        os.replace(tmp_index, self.index_path(date))
+        # 归档写好之后再删除原文件, 读取方总能在两者之一中读到完整数据
+        os.remove(csv_path)
+        return {
+            'date': date,
+            'rows': len(rows),
+            'blocks': len(blocks),
+            'raw_size': raw_size,
+            'size': size,
+            'ratio': round(raw_size / size, 2) if size else None
+        }
+
+    def stats(self):
+        """汇总全部归档的压缩情况"""
+        days = rows = raw_size = size = 0
+        for date in self.list_dates():
+            index = self.load_index(date)
+            if index is None:
+                continue
+            days += 1
+            rows += index['rows']
+            raw_size += index['raw_size']
+            size += index['size']
+        return {
+            'days': days,
+            'rows': rows,
+            'raw_size': raw_size,
+            'size': size,
+            'ratio': round(raw_size / size, 2) if size else None
+        }
+
+
+class CsvMessageStore:
+    """按天分文件的CSV消息存储
+
+    每天一个 daily_YYYYMMDD.csv 文件, 写入时保持当天文件的句柄常开,
+    读取在线程池中逐行解析, 不阻塞事件循环。已归档的日期透明地从压缩归档读取。
+    """
+
+    name = 'csv'
+
+    def __init__(self, data_dir, range_workers=4, archive=None):
+        self.data_dir = data_dir
+        self.archive = archive or DailyLogArchive(data_dir)
+        # 读取使用事件循环默认的线程池, 跨天查询使用单独的线程池并行扫描各天的文件
+        self.executor = None
+        self.range_executor = ThreadPoolExecutor(
+            max_workers=range_workers, thread_name_prefix='chat_analyzer_range')
+        self.range_workers = range_workers
+        self._file = None
+        self._file_date = None
+
+    def day_path(self, date):
+        """获取指定日期(YYYYMMDD)的消息记录文件路径"""
+        return os.path.join(self.data_dir, f'daily_{date}.csv')
+
+    def list_dates(self):
+        """列出已有消息记录的日期(升序)"""
+        dates = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith('daily_') and name.endswith('.csv'):
+                dates.append(name[len('daily_'):-len('.csv')])
+        return sorted(set(dates) | set(self.archive.list_dates()))
+
+    async def write_rows(self, rows):
+        """写入一批消息, 按日期拆分以处理跨天"""
+        start = 0
+        while start < len(rows):
+            date = row_date(rows[start][0])
+            end = start
+            while end < len(rows) and row_date(rows[end][0]) == date:
+                end += 1
+            await self._ensure_file(date)
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows[start:end])
+            await self._file.write(buf.getvalue())
+            await self._file.flush()
+            start = end
+
+    async def _ensure_file(self, date):
+        """确保当前打开的是指定日期的日志文件"""
+        if self._file is not None and self._file_date == date:
+            return
+        await self._close_file()
+        path = self.day_path(date)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = await aiofiles.open(path, 'a', encoding='utf-8', newline='')
+        self._file_date = date
+        if is_new:
+            buf = io.StringIO()
+            csv.writer(buf).writerow(LOG_HEADER)
+            await self._file.write(buf.getvalue())
+            storage_logger.info("创建新的日志文件: %s", path)
+
+    def write_rows_sync(self, rows):
+        """同步写入一批消息"""
+        for row in rows:
+            path = self.day_path(row_date(row[0]))
+            is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+            with open(path, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                if is_new:
+                    writer.writerow(LOG_HEADER)
+                writer.writerow(row)
+
+    def iter_day(self, date, group_id=None, sender_id=None):
+        """逐行读取某天的消息(同步生成器)"""
+        for row, _ in self.iter_page(date, group_id, sender_id=sender_id):
+            yield row
+
+    def iter_page(self, date, group_id=None, cursor=None, before=None, after=None, sender_id=None):
+        """从游标位置开始逐行读取某天的消息(同步生成器)
+
+        生成 (消息, 游标) 对。归档中的消息游标为 "a已读条数",
+        原始CSV中的游标是该行结束处的文件字节偏移,
+        下次从这里继续读取即可, 不需要重新解析前面的内容。
+        """
+        archived = self.archive.has(date)
+        if not cursor or cursor.startswith('a'):
+            start = int(cursor[1:]) if cursor else 0
+            for row, number in self.archive.iter_rows(date, start, group_id, sender_id, before, after):
+                yield row, f'a{number}'
+            cursor = None
+        path = self.day_path(date)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            if cursor and self.archive.has(date):
+                raise ValueError(f'{date} 的消息已归档, 游标已失效, 请从第一页重新查询')
+            # 读取过程中当天恰好被归档, 改从归档读取
+            if cursor is None and not archived and self.archive.has(date):
+                yield from self.iter_page(date, group_id, None, before, after, sender_id)
+            return
+        with f:
+            header = next(csv.reader([f.readline().decode('utf-8-sig')]), None)
+            if not header:
+                return
+            if cursor:
+                f.seek(int(cursor))
+            position = [f.tell()]
+
+            def lines():
+                while True:
+                    line = f.readline()
+                    # 忽略正在写入的不完整行
+                    if not line.endswith(b'\n'):
+                        return
+                    position[0] = f.tell()
+                    yield line.decode('utf-8')
+
+            rows_scanned = 0
+            try:
+                for values in csv.reader(lines()):
+                    rows_scanned += 1
+                    row = dict(zip(header, values))
+                    timestamp = row.get('timestamp', '')
+                    if before and timestamp >= before:
+                        return
+                    if after and timestamp <= after:
+                        continue
+                    if group_id and row.get('group_id') != group_id:
+                        continue
+                    if sender_id and row.get('sender_id') != sender_id:
+                        continue
+                    row.pop('raw_data', None)
+                    yield row, str(position[0])
+            finally:
+                HISTORY_ROWS_SCANNED.inc(rows_scanned, store='csv')
+
+    def _scan_chunk(self, date, position, max_rows, group_id, sender_id, before, after):
+        """从某天文件的指定位置最多读取 max_rows 条消息, 返回 (消息列表, 是否已读完)"""
+        rows = list(itertools.islice(
+            self.iter_page(date, group_id, position, before, after, sender_id), max_rows))
+        return rows, len(rows) < max_rows
+
+    def check_cursor(self, cursor):
+        """校验 iter_range 的游标 "日期:文件偏移"(归档中为 "日期:a已读条数"), 格式错误时抛出 ValueError"""
+        cursor_date, position = cursor.split(':', 1)
+        check_date(cursor_date)
+        if not (position[1:] if position.startswith('a') else position).isdigit():
+            raise ValueError(f'无效的游标: {cursor}')
+        # 文件偏移游标只对原始CSV有效, 该天归档之后无法对应到归档中的位置
+        if not position.startswith('a') and not os.path.exists(self.day_path(cursor_date)) \
+                and self.archive.has(cursor_date):
+            raise ValueError(f'{cursor_date} 的消息已归档, 游标已失效, 请从第一页重新查询')
+
+    async def iter_range(self, start_date, end_date, group_id=None, sender_id=None,
+                         cursor=None, before=None, after=None, chunk_rows=1000):
+        """按日期范围(含两端)流式读取消息, 生成 (消息, 游标)
+
+        先按文件名日期裁剪分区, 再在线程池中并行预读后面几天的第一块数据;
+        各天的时间互不重叠, 按日期顺序依次输出即为按时间排序的结果。
+        游标格式为 "日期:文件偏移"。
+        """
+        loop = asyncio.get_event_loop()
+        start_positions = {}
+        if cursor:
+            cursor_date, position = cursor.split(':', 1)
+            start_date = max(start_date, cursor_date)
+            start_positions[cursor_date] = position
+        dates = iter([date for date in self.list_dates() if start_date <= date <= end_date])
+
+        def submit(date, position):
+            return loop.run_in_executor(
+                self.range_executor, self._scan_chunk,
+                date, position, chunk_rows, group_id, sender_id, before, after)
+
+        pending = deque()
+
+        def prefetch():
+            date = next(dates, None)
+            if date is not None:
+                pending.append((date, submit(date, start_positions.get(date))))
+
+        for _ in range(self.range_workers):
+            prefetch()
+        try:
+            while pending:
+                date, future = pending.popleft()
+                prefetch()
+                while True:
+                    rows, finished = await future
+                    for row, position in rows:
+                        yield row, f'{date}:{position}'
+                    if finished:
+                        break
+                    future = submit(date, rows[-1][1])
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    async def read_day(self, date, group_id=None, sender_id=None):
+        """读取某天满足条件的全部消息"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, lambda: list(self.iter_day(date, group_id, sender_id)))
+
+    async def latest(self, date, limit, group_id=None, sender_id=None):
+        """读取某天满足条件的最新 limit 条消息"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, lambda: list(deque(self.iter_day(date, group_id, sender_id), maxlen=limit)))
+
+    async def read_range(self, start_date, end_date, group_id=None, sender_id=None):
+        """按日期范围(含两端)读取满足条件的消息, 按时间排序"""
+        return [row async for row, _ in self.iter_range(start_date, end_date, group_id, sender_id)]
+
+    async def read_written(self, start_date, end_date, group_id=None, sender_id=None):
+        """按日期范围(含两端)读取满足条件的消息, 按写入顺序排列
+
+        日志文件和归档中的行本来就是写入顺序, 与 read_range 相同。
+        """
+        return await self.read_range(start_date, end_date, group_id, sender_id)
+
+    async def groups(self, date):
+        """获取某天出现过的群号"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, lambda: {row['group_id'] for row in self.iter_day(date)})
+
+    def _version(self, start_date, end_date):
+        parts = []
+        last_modified = 0
+        for date in self.list_dates():
+            if not start_date <= date <= end_date:
+                continue
+            for path in (self.day_path(date), self.archive.index_path(date)):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                parts.append(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}')
+                last_modified = max(last_modified, stat.st_mtime)
+        return ';'.join(parts), last_modified
+
+    async def version(self, start_date, end_date):
+        """日期范围(含两端)内消息记录的版本
+
+        返回 (版本字符串, 最后修改时间), 版本由各天文件的大小和修改时间组成。
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._version, start_date, end_date)
+
+    async def close_day(self, date):
+        """关闭某天的日志文件(归档该天之前调用), 之后写入该天的消息会重新打开文件"""
+        if self._file_date == date:
+            await self._close_file()
+
+    async def _close_file(self):
+        if self._file is not None:
+            await self._file.close()
+            self._file = None
+            self._file_date = None
+
+    async def close(self):
+        await self._close_file()
+        self.range_executor.shutdown(wait=False)
+
+
+class SqliteMessageStore:
+    """基于SQLite(WAL模式)的消息存储
+
+    按 (group_id, timestamp) 和 (group_id, sender_id, timestamp) 建索引,
+    所有数据库操作都在单独的线程中串行执行。
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat_analyzer_sqlite')
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                group_id TEXT NOT NULL,
+                group_name TEXT NOT NULL DEFAULT '',
+                sender_id TEXT NOT NULL,
+                sender_name TEXT NOT NULL DEFAULT '',
+                text_message TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_time
+                ON messages(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_messages_group_time
+                ON messages(group_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_messages_group_sender_time
+                ON messages(group_id, sender_id, timestamp);
+            CREATE TABLE IF NOT EXISTS imported_files (
+                name TEXT PRIMARY KEY,
+                rows INTEGER NOT NULL,
+                imported_at TEXT NOT NULL
+            );
+        """)
+        self._conn.commit()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    @staticmethod
+    def _day_range(date, end_date=None):
+        """把日期(YYYYMMDD)范围转换为时间戳范围 [start, end)"""
+        day = datetime.strptime(date, '%Y%m%d')
+        last_day = datetime.strptime(end_date, '%Y%m%d') if end_date else day
+        return (day.strftime('%Y-%m-%d 00:00:00'),
+                (last_day + timedelta(days=1)).strftime('%Y-%m-%d 00:00:00'))
+
+    @staticmethod
+    def _where(date, group_id=None, sender_id=None, end_date=None):
+        start, end = SqliteMessageStore._day_range(date, end_date)
+        clauses = ['timestamp >= ?', 'timestamp < ?']
+        params = [start, end]
+        if group_id:
+            clauses.append('group_id = ?')
+            params.append(group_id)
+        if sender_id:
+            clauses.append('sender_id = ?')
+            params.append(sender_id)
+        return ' AND '.join(clauses), params
+
+    def write_rows_sync(self, rows):
+        """同步写入一批消息(按 LOG_HEADER 顺序的行)"""
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO messages (timestamp, group_id, group_name, sender_id, sender_name, text_message) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [row[:6] for row in rows])
+
+    async def write_rows(self, rows):
+        """写入一批消息"""
+        await self._run(self.write_rows_sync, rows)
+
+    def iter_day(self, date, group_id=None, sender_id=None):
+        """逐行读取某天的消息(同步生成器)"""
+        where, params = self._where(date, group_id, sender_id)
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE {where} ORDER BY timestamp, id",
+            params)
+        rows_scanned = 0
+        try:
+            for row in cursor:
+                rows_scanned += 1
+                yield dict(row)
+        finally:
+            HISTORY_ROWS_SCANNED.inc(rows_scanned, store='sqlite')
+
+    def check_cursor(self, cursor):
+        """校验 iter_range 的游标 "日期:时间戳/行号", 格式错误时抛出 ValueError"""
+        cursor_date, position = cursor.split(':', 1)
+        check_date(cursor_date)
+        timestamp, row_id = position.rsplit('/', 1)
+        int(row_id)
+
+    async def iter_range(self, start_date, end_date, group_id=None, sender_id=None,
+                         cursor=None, before=None, after=None, chunk_rows=1000):
+        """按日期范围(含两端)流式读取消息, 生成 (消息, 游标)
+
+        通过索引一次查询, 在数据库线程中分块取出结果。游标格式为 "日期:时间戳/行号"。
+        """
+        if cursor:
+            cursor_date, cursor = cursor.split(':', 1)
+            start_date = max(start_date, cursor_date)
+        where, params = self._where(start_date, group_id, sender_id, end_date)
+        if cursor:
+            timestamp, row_id = cursor.rsplit('/', 1)
+            where += ' AND (timestamp > ? OR (timestamp = ? AND id > ?))'
+            params += [timestamp, timestamp, int(row_id)]
+        if before:
+            where += ' AND timestamp < ?'
+            params.append(before)
+        if after:
+            where += ' AND timestamp > ?'
+            params.append(after)
+        rows = await self._run(lambda: self._conn.execute(
+            f"SELECT id, {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE {where} ORDER BY timestamp, id",
+            params))
+        try:
+            while True:
+                chunk = await self._run(rows.fetchmany, chunk_rows)
+                HISTORY_ROWS_SCANNED.inc(len(chunk), store='sqlite')
+                for row in chunk:
+                    row = dict(row)
+                    row_id = row.pop('id')
+                    yield row, f"{row_date(row['timestamp'])}:{row['timestamp']}/{row_id}"
+                if len(chunk) < chunk_rows:
+                    break
+        finally:
+            await self._run(rows.close)
+
+    async def read_day(self, date, group_id=None, sender_id=None):
+        """读取某天满足条件的全部消息"""
+        return await self._run(lambda: list(self.iter_day(date, group_id, sender_id)))
+
+    async def latest(self, date, limit, group_id=None, sender_id=None):
+        """读取某天满足条件的最新 limit 条消息"""
+        where, params = self._where(date, group_id, sender_id)
+
+        def query():
+            rows = self._conn.execute(
+                f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE {where} "
+                f"ORDER BY timestamp DESC, id DESC LIMIT ?",
+                params + [limit]).fetchall()
+            HISTORY_ROWS_SCANNED.inc(len(rows), store='sqlite')
+            return [dict(row) for row in reversed(rows)]
+
+        return await self._run(query)
+
+    async def read_range(self, start_date, end_date, group_id=None, sender_id=None):
+        """按日期范围(含两端)读取满足条件的消息, 按时间排序"""
+        return [row async for row, _ in self.iter_range(start_date, end_date, group_id, sender_id)]
+
+    async def read_written(self, start_date, end_date, group_id=None, sender_id=None):
+        """按日期范围(含两端)读取满足条件的消息, 按写入顺序(行号)排列"""
+        where, params = self._where(start_date, group_id, sender_id, end_date)
+
+        def query():
+            rows = self._conn.execute(
+                f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE {where} ORDER BY id",
+                params).fetchall()
+            HISTORY_ROWS_SCANNED.inc(len(rows), store='sqlite')
+            return [dict(row) for row in rows]
+
+        return await self._run(query)
+
+    async def groups(self, date):
+        """获取某天出现过的群号"""
+        where, params = self._where(date)
+
+        def query():
+            rows = self._conn.execute(
+                f"SELECT DISTINCT group_id FROM messages WHERE {where}", params).fetchall()
+            return {row['group_id'] for row in rows}
+
+        return await self._run(query)
+
+    async def version(self, start_date, end_date):
+        """日期范围(含两端)内消息记录的版本
+
+        返回 (版本字符串, 最后修改时间)。新消息总是写入今天,
+        已结束日期的数据只会因导入CSV而变化, 所以版本由最大行号和已导入文件数组成,
+        不需要扫描范围内的数据。
+        """
+        def query():
+            max_id = self._conn.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+            imported = self._conn.execute('SELECT COUNT(*) FROM imported_files').fetchone()[0]
+            return f'{max_id}:{imported}'
+
+        version = await self._run(query)
+        last_modified = 0
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                last_modified = max(last_modified, os.path.getmtime(path))
+            except FileNotFoundError:
+                pass
+        return version, last_modified
+
+    def import_csv_files(self, data_dir, archive=None):
+        """一次性导入数据目录中尚未导入过的 daily_*.csv 文件(包括已归档的), 返回导入的行数"""
+        imported = {row['name'] for row in self._conn.execute('SELECT name FROM imported_files')}
+        names = {name for name in os.listdir(data_dir) if name.startswith('daily_') and name.endswith('.csv')}
+        if archive is not None:
+            names |= {f'daily_{date}.csv' for date in archive.list_dates()}
+        total = 0
+        for name in sorted(names):
+            if name in imported:
+                continue
+            rows = []
+            if archive is not None:
+                date = name[len('daily_'):-len('.csv')]
+                rows = [[row[column] for column in MESSAGE_COLUMNS] for row, _ in archive.iter_rows(date)]
+            path = os.path.join(data_dir, name)
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    for row in csv.DictReader(f):
+                        rows.append([row.get(column) or '' for column in MESSAGE_COLUMNS])
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT INTO messages (timestamp, group_id, group_name, sender_id, sender_name, text_message) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self._conn.execute(
+                    'INSERT INTO imported_files (name, rows, imported_at) VALUES (?, ?, ?)',
+                    (name, len(rows), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            storage_logger.info("已导入 %s: %d 条消息", name, len(rows))
+            total += len(rows)
+        return total
+
+    async def import_csv(self, data_dir, archive=None):
+        """在数据库线程中导入CSV记录"""
+        return await self._run(self.import_csv_files, data_dir, archive)
+
+    async def close_day(self, date):
+        """消息不写入CSV文件, 归档前不需要关闭文件"""
+
+    async def close(self):
+        await self._run(self._conn.commit)
+        await self._run(self._conn.close)
+        self.executor.shutdown(wait=False)
+
+
+class UserProfileStore:
+    """用户画像存储: 每个 (群, 用户) 一个JSON文件
+
+    文件中记录画像内容和已合并进画像的最后一条消息(高水位),
+    之后只需把高水位之后的新消息合并进已有画像。
+    """
+
+    def __init__(self, profile_dir):
+        self.profile_dir = profile_dir
+
+    def _path(self, group_id, user_id):
+        return os.path.join(self.profile_dir, quote(str(group_id), safe=''),
+                            f"{quote(str(user_id), safe='')}.json")
+
+    def load(self, group_id, user_id):
+        """读取用户画像, 不存在时返回None"""
+        path = self._path(group_id, user_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, profile):
+        """保存用户画像"""
+        path = self._path(profile['group_id'], profile['user_id'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(profile, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def list_group(self, group_id):
+        """列出某个群的全部用户画像"""
+        group_dir = os.path.join(self.profile_dir, quote(str(group_id), safe=''))
+        if not os.path.isdir(group_dir):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(group_dir)):
+            if name.endswith('.json'):
+                with open(os.path.join(group_dir, name), 'r', encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+        return profiles
+
+    @staticmethod
+    def after_mark(messages, mark):
+        """取出高水位之后的消息, 返回 [(消息, 该消息是用户当天的第几条)]
+
+        messages 为从高水位所在日期开始、按写入顺序排列的该用户的消息。高水位记录
+        日期以及当天已合并的条数, 按位置而不是时间戳比较, 时间戳乱序写入的消息也
+        不会被跳过。旧版按时间戳记录的高水位仍按时间戳比较。
+        """
+        legacy = bool(mark) and 'timestamp' in mark
+        positions = {}
+        result = []
+        skipped = 0
+        for msg in messages:
+            date = row_date(msg['timestamp'])
+            position = positions.get(date, 0)
+            positions[date] = position + 1
+            if legacy:
+                if msg['timestamp'] < mark['timestamp']:
+                    continue
+                if msg['timestamp'] == mark['timestamp'] and skipped < mark['seen']:
+                    skipped += 1
+                    continue
+            elif mark and (date < mark['date'] or (date == mark['date'] and position < mark['count'])):
+                continue
+            result.append((msg, position))
+        return result
+
+    @staticmethod
+    def mark_date(mark):
+        """高水位所在的日期"""
+        return mark['date'] if 'date' in mark else row_date(mark['timestamp'])
+
+    @staticmethod
+    def advance_mark(mark, merged):
+        """推进高水位到最后一条已合并的消息, merged 为 after_mark 返回的前若干项"""
+        if not merged:
+            return mark
+        msg, position = merged[-1]
+        return {'date': row_date(msg['timestamp']), 'count': position + 1}
+
+
+class SummaryStore:
+    """按天分区的总结存储
+
+    总结按被总结消息的日期(source_date)写入 summaries/YYYYMMDD.csv, 凌晨生成的
+    前一天的每日总结也归入前一天。index.json 记录每个分区中各 (群, 类型) 的条数,
+    查询时跳过没有匹配记录的分区, 总数直接由索引得出。
+    """
+
+    def __init__(self, summary_dir):
+        self.summary_dir = summary_dir
+        self.index_path = os.path.join(summary_dir, 'index.json')
+        os.makedirs(summary_dir, exist_ok=True)
+        self._lock = asyncio.Lock()
+        self._partitions = {}
+        self.load_index()
+
+    def _partition_path(self, date):
+        return os.path.join(self.summary_dir, f'{date}.csv')
+
+    @staticmethod
+    def _key(group_id, summary_type):
+        return f'{group_id}\t{summary_type}'
+
+    @staticmethod
+    def record_date(row):
+        """总结所属的分区日期: 被总结消息的日期, 旧记录没有该列时使用生成时间"""
+        return row.get('source_date') or row_date(row['timestamp'])
+
+    def _read_partition(self, date):
+        path = self._partition_path(date)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            return list(csv.DictReader(f))
+
+    def _index_partition(self, date):
+        counts = {}
+        for row in self._read_partition(date):
+            key = self._key(row['group_id'], row['summary_type'])
+            counts[key] = counts.get(key, 0) + 1
+        self._partitions[date] = {
+            'size': os.path.getsize(self._partition_path(date)),
+            'counts': counts
+        }
+
+    def load_index(self):
+        """加载索引, 并重建与分区文件大小不一致的条目"""
+        repartition = False
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                if 'partitions' in index:
+                    self._partitions = index['partitions']
+                else:
+                    # 旧版索引按生成时间分区, 需要重新按 source_date 分区
+                    repartition = True
+            except Exception as e:
+                storage_logger.exception("加载总结索引错误")
+                self._partitions = {}
+        if repartition:
+            moved = self.repartition()
+            storage_logger.info("已把 %d 条总结按被总结的日期重新分区", moved)
+        changed = repartition
+        dates = set()
+        for name in os.listdir(self.summary_dir):
+            if not (name.endswith('.csv') and name[:-4].isdigit()):
+                continue
+            date = name[:-4]
+            dates.add(date)
+            entry = self._partitions.get(date)
+            if entry is None or entry['size'] != os.path.getsize(self._partition_path(date)):
+                self._index_partition(date)
+                changed = True
+        for date in list(self._partitions):
+            if date not in dates:
+                del self._partitions[date]
+                changed = True
+        if changed:
+            self.save_index()
+
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'partitions': self._partitions}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _write_partition(self, date, rows):
+        tmp_path = self._partition_path(date) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_HEADER, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self._partition_path(date))
+
+    def repartition(self):
+        """把按生成时间分区的总结改为按 source_date 分区, 返回换了分区的条数"""
+        dates = sorted(name[:-4] for name in os.listdir(self.summary_dir)
+                       if name.endswith('.csv') and name[:-4].isdigit())
+        by_date = {}
+        moved = 0
+        for date in dates:
+            for row in self._read_partition(date):
+                target = self.record_date(row)
+                moved += target != date
+                by_date.setdefault(target, []).append(row)
+        for date, rows in by_date.items():
+            self._write_partition(date, rows)
+        for date in dates:
+            if date not in by_date:
+                os.remove(self._partition_path(date))
+        self._partitions = {}
+        return moved
+
+    def migrate_legacy(self, legacy_path):
+        """把旧版单文件 summary.csv 按日期拆分到各分区, 完成后重命名旧文件"""
+        if not os.path.exists(legacy_path):
+            return 0
+        with open(legacy_path, 'r', encoding='utf-8', newline='') as f:
+            rows = list(csv.DictReader(f))
+        by_date = {}
+        for row in rows:
+            by_date.setdefault(self.record_date(row), []).append(row)
+        for date, date_rows in by_date.items():
+            path = self._partition_path(date)
+            is_new = not os.path.exists(path)
+            with open(path, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=SUMMARY_HEADER, extrasaction='ignore')
+                if is_new:
+                    writer.writeheader()
+                writer.writerows(date_rows)
+            self._index_partition(date)
+        self.save_index()
+        os.replace(legacy_path, legacy_path + '.migrated')
+        return len(rows)
+
+    async def append(self, row):
+        """追加一条总结(按 SUMMARY_HEADER 的字典)"""
+        date = self.record_date(row)
+        path = self._partition_path(date)
+        async with self._lock:
+            is_new = not os.path.exists(path)
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=SUMMARY_HEADER, extrasaction='ignore')
+            if is_new:
+                writer.writeheader()
+            writer.writerow(row)
+            async with aiofiles.open(path, 'a', encoding='utf-8', newline='') as f:
+                await f.write(buf.getvalue())
+            entry = self._partitions.setdefault(date, {'size': 0, 'counts': {}})
+            key = self._key(row['group_id'], row['summary_type'])
+            entry['counts'][key] = entry['counts'].get(key, 0) + 1
+            entry['size'] = os.path.getsize(path)
+            self.save_index()
+
+    def _matching_count(self, date, group_id, summary_type):
+        total = 0
+        for key, count in self._partitions[date]['counts'].items():
+            key_group, key_type = key.split('\t', 1)
+            if (not group_id or key_group == group_id) and (not summary_type or key_type == summary_type):
+                total += count
+        return total
+
+    def _plan(self, group_id, summary_type, from_date, to_date):
+        """根据索引选出有匹配记录的分区(新到旧)和匹配总数"""
+        dates = []
+        total = 0
+        for date in sorted(self._partitions, reverse=True):
+            if (from_date and date < from_date) or (to_date and date > to_date):
+                continue
+            count = self._matching_count(date, group_id, summary_type)
+            if count:
+                dates.append(date)
+                total += count
+        return dates, total
+
+    def _scan(self, dates, group_id, summary_type, cursor=None):
+        """按从新到旧的顺序逐条生成 (日期, 行号, 总结)"""
+        for date in dates:
+            if cursor and date > cursor[0]:
+                continue
+            rows = self._read_partition(date)
+            end = len(rows)
+            if cursor and date == cursor[0]:
+                end = min(end, cursor[1])
+            for index in range(end - 1, -1, -1):
+                row = rows[index]
+                if group_id and row['group_id'] != group_id:
+                    continue
+                if summary_type and row['summary_type'] != summary_type:
+                    continue
+                yield date, index, row
+
+    def version(self, from_date=None, to_date=None):
+        """日期范围内总结的版本, 返回 (由各分区大小组成的版本字符串, 最后修改时间)"""
+        parts = []
+        last_modified = 0
+        for date in sorted(self._partitions):
+            if (from_date and date < from_date) or (to_date and date > to_date):
+                continue
+            parts.append(f"{date}:{self._partitions[date]['size']}")
+            try:
+                last_modified = max(last_modified, os.path.getmtime(self._partition_path(date)))
+            except FileNotFoundError:
+                pass
+        return ';'.join(parts), last_modified
+
+    @staticmethod
+    def check_cursor(cursor):
+        """校验 query 的游标 "日期:行号", 格式错误时抛出 ValueError"""
+        cursor_date, cursor_index = cursor.split(':', 1)
+        check_date(cursor_date)
+        if not cursor_index.isdigit():
+            raise ValueError(f'无效的游标: {cursor}')
+
+    async def query(self, group_id=None, summary_type=None, from_date=None, to_date=None,
+                    limit=50, cursor=None):
+        """分页查询总结, 从新到旧排列
+
+        cursor 为上一页返回的 "日期:行号", 返回 (总结列表, 匹配总数, 下一页游标)。
+        """
+        dates, total = self._plan(group_id, summary_type, from_date, to_date)
+        if cursor:
+            cursor_date, cursor_index = cursor.split(':', 1)
+            cursor = (cursor_date, int(cursor_index))
+
+        def collect():
+            return list(itertools.islice(self._scan(dates, group_id, summary_type, cursor), limit + 1))
+
+        found = await asyncio.get_event_loop().run_in_executor(None, collect)
+        next_cursor = None
+        if len(found) > limit:
+            found = found[:limit]
+            next_cursor = f'{found[-1][0]}:{found[-1][1]}'
+        return [row for _, _, row in found], total, next_cursor
+
+    async def export(self, group_id=None, summary_type=None, from_date=None, to_date=None):
+        """导出全部匹配的总结为CSV文本"""
+        dates, _ = self._plan(group_id, summary_type, from_date, to_date)
+
+        def build():
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=SUMMARY_HEADER, extrasaction='ignore')
+            writer.writeheader()
+            for _, _, row in self._scan(dates, group_id, summary_type):
+                writer.writerow(row)
+            return buf.getvalue()
+
+        return await asyncio.get_event_loop().run_in_executor(None, build)
+
+
+class SingleFlightCache:
+    """合并相同请求的并发计算, 并把结果缓存一小段时间
+
+    键的第一项为群号, 群里有新消息时通过 invalidate_group 清除该群的缓存。
+    """
+
+    def __init__(self, ttl=300, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inflight = {}
+        self._results = OrderedDict()
+        self._group_keys = {}
+
+    async def run(self, key, compute, cacheable=None):
+        """返回 (结果, 来源), 来源为 cache / shared / computed
+
+        compute 为返回协程的函数; cacheable 判断结果是否可以缓存。
+        """
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                return cached[1], 'cache'
+            self._remove(key)
+
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future), 'shared'
+
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await compute()
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(result)
+
+        if cacheable is None or cacheable(result):
+            self._results[key] = (time.monotonic() + self.ttl, result)
+            self._group_keys.setdefault(key[0], set()).add(key)
+            while len(self._results) > self.max_entries:
+                self._remove(next(iter(self._results)))
+        return result, 'computed'
+
+    def _remove(self, key):
+        self._results.pop(key, None)
+        keys = self._group_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._group_keys[key[0]]
+
+    def invalidate_group(self, group_id):
+        """清除某个群的全部缓存结果"""
+        for key in self._group_keys.pop(group_id, ()):
+            self._results.pop(key, None)
+
+
+class RecentMessageCache:
+    """按群(以及群内用户)保存当天最近消息的环形缓冲区
+
+    每个群最多保留 group_depth 条, 每个用户最多保留 user_depth 条,
+    总条数超过 max_total 时优先淘汰最久没有新消息的群。
+    """
+
+    def __init__(self, group_depth=500, user_depth=100, max_total=100000):
+        self.group_depth = group_depth
+        self.user_depth = user_depth
+        self.max_total = max_total
+        self.date = None
+        self._groups = OrderedDict()
+        self._evicted = set()
+        self._total = 0
+
+    @property
+    def total(self):
+        """当前缓存的消息总条数(群与用户缓冲区合计)"""
+        return self._total
+
+    def reset(self, date=None):
+        """清空缓存并切换到指定日期"""
+        self.date = date
+        self._groups.clear()
+        self._evicted.clear()
+        self._total = 0
+
+    def add(self, row):
+        """加入一条消息, 消息日期变化时自动切换到新的一天"""
+        date = row['timestamp'][:10].replace('-', '')
+        if date != self.date:
+            if self.date is not None and date < self.date:
+                return
+            self.reset(date)
+
+        group_id = row['group_id']
+        entry = self._groups.get(group_id)
+        if entry is None:
+            # 被淘汰过的群缓存不再完整, 读取时可能需要回退到文件
+            entry = {
+                'messages': deque(maxlen=self.group_depth),
+                'users': {},
+                'complete': group_id not in self._evicted
+            }
+            self._groups[group_id] = entry
+        else:
+            self._groups.move_to_end(group_id)
+
+        self._append(entry['messages'], row)
+        user_messages = entry['users'].get(row['sender_id'])
+        if user_messages is None:
+            user_messages = entry['users'][row['sender_id']] = deque(maxlen=self.user_depth)
+        self._append(user_messages, row)
+
+        while self._total > self.max_total and len(self._groups) > 1:
+            evicted_id, evicted = self._groups.popitem(last=False)
+            self._total -= len(evicted['messages'])
+            self._total -= sum(len(m) for m in evicted['users'].values())
+            self._evicted.add(evicted_id)
+
+    def _append(self, buffer, row):
+        if len(buffer) < buffer.maxlen:
+            self._total += 1
+        buffer.append(row)
+
+    def latest(self, date, group_id, limit):
+        """获取群内最新 limit 条消息, 缓存无法给出完整结果时返回None"""
+        if date != self.date:
+            return None
+        entry = self._groups.get(group_id)
+        if entry is None:
+            return [] if group_id not in self._evicted else None
+        return self._take(entry['messages'], limit, entry['complete'])
+
+    def latest_user(self, date, group_id, user_id, limit):
+        """获取群内某用户最新 limit 条消息, 缓存无法给出完整结果时返回None"""
+        if date != self.date:
+            return None
+        entry = self._groups.get(group_id)
+        if entry is None:
+            return [] if group_id not in self._evicted else None
+        user_messages = entry['users'].get(user_id)
+        if user_messages is None:
+            return [] if entry['complete'] else None
+        return self._take(user_messages, limit, entry['complete'])
+
+    def _take(self, buffer, limit, complete):
+        if len(buffer) >= limit:
+            return list(buffer)[-limit:] if limit else []
+        # 缓冲区未满说明没有丢弃过消息, 只要群缓存完整即为全部消息
+        if complete and len(buffer) < buffer.maxlen:
+            return list(buffer)
+        return None
+
+
+class GroupCatalog:
+    """群目录: 按天记录每个群的名称、首次/最后发言时间和消息数
+
+    随消息写入增量更新, 定期保存为数据目录下的 groups.json。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._days = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        """从文件加载群目录"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._days = json.load(f)
+        except Exception as e:
+            storage_logger.exception("加载群目录错误")
+
+    def save(self):
+        """有变化时把群目录写入文件"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._days, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def has_day(self, date):
+        return date in self._days
+
+    def record(self, row):
+        """记录一条消息"""
+        day = self._days.setdefault(row_date(row['timestamp']), {})
+        entry = day.get(row['group_id'])
+        if entry is None:
+            entry = day[row['group_id']] = {
+                'group_name': '',
+                'first_seen': row['timestamp'],
+                'last_seen': row['timestamp'],
+                'message_count': 0
+            }
+        if row.get('group_name'):
+            entry['group_name'] = row['group_name']
+        entry['last_seen'] = row['timestamp']
+        entry['message_count'] += 1
+        self._dirty = True
+
+    def rebuild_day(self, date, rows):
+        """用某天的全部消息重建该天的目录"""
+        self._days[date] = {}
+        for row in rows:
+            self.record(row)
+        # 当天没有消息时也记录下来, 避免重复重建
+        self._days.setdefault(date, {})
+        self._dirty = True
+
+    def groups(self, date=None):
+        """获取某天(不指定时为全部日期汇总)的群列表"""
+        if date is not None:
+            days = [self._days.get(date, {})]
+        else:
+            days = [self._days[d] for d in sorted(self._days)]
+        merged = {}
+        for day in days:
+            for group_id, entry in day.items():
+                current = merged.get(group_id)
+                if current is None:
+                    merged[group_id] = dict(entry, group_id=group_id)
+                    continue
+                current['group_name'] = entry['group_name'] or current['group_name']
+                current['last_seen'] = entry['last_seen']
+                current['message_count'] += entry['message_count']
+        return sorted(merged.values(), key=lambda g: g['group_id'])
+
+
+# 消息长度分布的分段上限(字数), 最后一段为更长的消息
+LENGTH_BUCKETS = [5, 10, 20, 50, 100, 200]
+LENGTH_LABELS = ['1-5', '6-10', '11-20', '21-50', '51-100', '101-200', '200以上']
+
+
+class ActivityStats:
+    """群活跃统计: 按天、按群累计消息数、每小时分布、消息长度分布和每个成员的发言情况
+
+    随消息写入增量更新, 定期把有变化的日期保存为 stats/YYYYMMDD.json。文件中的 rows
+    为已统计的消息条数, 重启时只需补上之后写入的消息; 没有统计文件的历史日期
+    在第一次查询时从消息记录统计。内存中最多保留 cache_days 天。
+    """
+
+    def __init__(self, stats_dir, cache_days=31):
+        self.stats_dir = stats_dir
+        self.cache_days = cache_days
+        self._days = OrderedDict()
+        self._dirty = set()
+        os.makedirs(stats_dir, exist_ok=True)
+
+    def path(self, date):
+        return os.path.join(self.stats_dir, f'{date}.json')
+
+    @staticmethod
+    def new_day():
+        return {'rows': 0, 'groups': {}}
+
+    @staticmethod
+    def add_row(day, row):
+        """把一条消息计入某天的统计"""
+        day['rows'] += 1
+        group = day['groups'].get(row['group_id'])
+        if group is None:
+            group = day['groups'][row['group_id']] = {
+                'group_name': '',
+                'messages': 0,
+                'chars': 0,
+                'hours': [0] * 24,
+                'lengths': [0] * len(LENGTH_LABELS),
+                'users': {}
+            }
+        text = row.get('text_message') or ''
+        try:
+            hour = int(row['timestamp'][11:13])
+        except ValueError:
+            hour = 0
+        if row.get('group_name'):
+            group['group_name'] = row['group_name']
+        group['messages'] += 1
+        group['chars'] += len(text)
+        group['hours'][hour] += 1
+        group['lengths'][bisect.bisect_left(LENGTH_BUCKETS, len(text))] += 1
+        user = group['users'].get(row['sender_id'])
+        if user is None:
+            user = group['users'][row['sender_id']] = {'name': '', 'messages': 0, 'chars': 0, 'hours': {}}
+        if row.get('sender_name'):
+            user['name'] = row['sender_name']
+        user['messages'] += 1
+        user['chars'] += len(text)
+        # JSON 的键只能是字符串
+        user['hours'][str(hour)] = user['hours'].get(str(hour), 0) + 1
+
+    def has_day(self, date):
+        return date in self._days or os.path.exists(self.path(date))
+
+    def get_day(self, date):
+        """获取某天的统计, 没有时返回 None"""
+        day = self._days.get(date)
+        if day is not None:
+            self._days.move_to_end(date)
+            return day
+        try:
+            with open(self.path(date), 'r', encoding='utf-8') as f:
+                day = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            storage_logger.exception("加载 %s 的活跃统计错误", date)
+            return None
+        self._store(date, day)
+        return day
+
+    def _store(self, date, day):
+        self._days[date] = day
+        self._days.move_to_end(date)
+        self._evict()
+
+    def _evict(self):
+        # 只淘汰已经保存的日期, 最近使用的日期在末尾
+        for old in list(self._days)[:-1]:
+            if len(self._days) <= self.cache_days:
+                break
+            if old not in self._dirty:
+                del self._days[old]
+
+    def record(self, row):
+        """记录一条新消息"""
+        date = row_date(row['timestamp'])
+        day = self.get_day(date)
+        if day is None:
+            day = self.new_day()
+            self._store(date, day)
+        self.add_row(day, row)
+        self._dirty.add(date)
+
+    def catch_up(self, date, rows):
+        """rows 为某天按写入顺序的全部消息, 只统计上次保存之后写入的部分"""
+        day = self.get_day(date)
+        if day is None or day['rows'] > len(rows):
+            self.rebuild_day(date, rows)
+            return
+        for row in rows[day['rows']:]:
+            self.add_row(day, row)
+            self._dirty.add(date)
+
+    def rebuild_day(self, date, rows):
+        """用某天的全部消息重新统计该天"""
+        day = self.new_day()
+        for row in rows:
+            self.add_row(day, row)
+        self._store(date, day)
+        # 没有消息的日期只留在内存中, 重新统计的代价很小
+        if rows:
+            self._dirty.add(date)
+
+    def save(self):
+        """把有变化的日期写入文件"""
+        for date in sorted(self._dirty):
+            day = self._days.get(date)
+            if day is None:
+                continue
+            tmp_path = self.path(date) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(day, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path(date))
+        self._dirty.clear()
+        self._evict()
+
+    def report(self, dates, group_id=None, sender_id=None, top=10):
+        """汇总若干天的统计
+
+        指定群时只统计该群, 指定成员时只统计该成员的发言(消息数、小时分布等均为该成员的)。
+        返回消息数、发言人数、每小时分布、长度分布、发言最多的成员和各群的概况。
+        """
+        hours = [0] * 24
+        lengths = [0] * len(LENGTH_LABELS)
+        messages = 0
+        chars = 0
+        users = {}
+        groups = {}
+        for date in dates:
+            day = self.get_day(date)
+            if day is None:
+                continue
+            for entry_group, group in day['groups'].items():
+                if group_id and entry_group != group_id:
+                    continue
+                summary = groups.setdefault(entry_group, {
+                    'group_id': entry_group, 'group_name': '', 'messages': 0, 'users': set()})
+                summary['group_name'] = group['group_name'] or summary['group_name']
+                if sender_id:
+                    # 成员的发言没有单独统计长度分布
+                    user = group['users'].get(sender_id)
+                    if user is None:
+                        continue
+                    for hour, count in user['hours'].items():
+                        hours[int(hour)] += count
+                    group_users = {sender_id: user}
+                    group_messages, group_chars = user['messages'], user['chars']
+                else:
+                    hours = [a + b for a, b in zip(hours, group['hours'])]
+                    lengths = [a + b for a, b in zip(lengths, group['lengths'])]
+                    group_users = group['users']
+                    group_messages, group_chars = group['messages'], group['chars']
+                messages += group_messages
+                chars += group_chars
+                summary['messages'] += group_messages
+                summary['users'].update(group_users)
+                for user_id, user in group_users.items():
+                    merged = users.setdefault(user_id, {'sender_id': user_id, 'sender_name': '',
+                                                        'messages': 0, 'chars': 0})
+                    merged['sender_name'] = user['name'] or merged['sender_name']
+                    merged['messages'] += user['messages']
+                    merged['chars'] += user['chars']
+        top_posters = sorted(users.values(), key=lambda user: user['messages'], reverse=True)[:top]
+        for user in top_posters:
+            user['share'] = round(user['messages'] / messages, 4) if messages else 0
+        return {
+            'messages': messages,
+            'active_users': len(users),
+            'avg_length': round(chars / messages, 1) if messages else 0,
+            'hours': hours,
+            'lengths': [{'label': label, 'count': count} for label, count in zip(LENGTH_LABELS, lengths)],
+            'top_posters': top_posters,
+            'groups': sorted(({'group_id': group['group_id'], 'group_name': group['group_name'],
+                               'messages': group['messages'], 'active_users': len(group['users'])}
+                              for group in groups.values() if group['messages']),
+                             key=lambda group: group['messages'], reverse=True)
+        }
+
+
+def format_activity_stats(report, top=5):
+    """把活跃统计整理为提示词中的文字, 供总结的成员互动部分引用"""
+    messages = report['messages']
+    if not messages:
+        return ''
+    lines = [f"消息总数 {messages} 条, 发言人数 {report['active_users']} 人, "
+             f"人均 {messages / max(report['active_users'], 1):.1f} 条, 平均每条 {report['avg_length']} 字"]
+    posters = report['top_posters'][:top]
+    if posters:
+        lines.append('发言最多: ' + ', '.join(
+            f"{user['sender_name'] or user['sender_id']} {user['messages']} 条({user['share']:.0%})"
+            for user in posters))
+        top_share = sum(user['messages'] for user in posters) / messages
+        lines.append(f'前 {len(posters)} 名成员发言占比 {top_share:.0%}')
+    peak_hours = sorted(range(24), key=lambda hour: report['hours'][hour], reverse=True)[:3]
+    lines.append('最活跃时段: ' + ', '.join(
+        f"{hour}时 {report['hours'][hour]} 条" for hour in peak_hours if report['hours'][hour]))
+    if any(item['count'] for item in report['lengths']):
+        lines.append('消息长度分布: ' + ', '.join(
+            f"{item['label']}字 {item['count'] / messages:.0%}" for item in report['lengths'] if item['count']))
+    return '\n'.join(lines)
+
+
+# 中日韩文字按二元组切分, 其余字母数字按单词切分(小写)
+CJK_PATTERN = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+WORD_PATTERN = re.compile(r'[^\W_]+')
+
+
+def tokenize_text(text):
+    """把文本切分为检索用的词项: 中日韩文字取相邻二元组(单字取单字), 拉丁文字取整词"""
+    tokens = []
+    position = 0
+    for match in CJK_PATTERN.finditer(text):
+        tokens.extend(WORD_PATTERN.findall(text[position:match.start()].lower()))
+        run = match.group()
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        position = match.end()
+    tokens.extend(WORD_PATTERN.findall(text[position:].lower()))
+    return tokens
+
+
+def highlight_snippet(text, terms, width=40):
+    """截取第一个命中词附近的片段, HTML转义后用 <mark> 标出所有命中词"""
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                         re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(0, match.start() - width) if match else 0
+    end = min(len(text), (match.end() if match else 0) + width * 2)
+    snippet = text[start:end]
+    parts = []
+    last = 0
+    for found in pattern.finditer(snippet):
+        parts.append(html.escape(snippet[last:found.start()]))
+        parts.append(f'<mark>{html.escape(found.group())}</mark>')
+        last = found.end()
+    parts.append(html.escape(snippet[last:]))
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(text) else '')
+
+
+class SearchIndex:
+    """全文倒排索引
+
+    今天的索引随消息写入在内存中增量更新, 启动时从今天的消息记录重建;
+    日期切换后把前一天的索引写入 search.db, 之后不再变化。历史日期没有索引时
+    在第一次查询时建立。search.db 按 (词项, 日期, 群) 保存倒排表, 每项是
+    array('I') 编码的 [消息序号, 词频, ...], 查询只读取查询词对应的倒排表。
+    所有数据库操作都在单独的线程中串行执行。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat_analyzer_search')
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS days (
+                date TEXT PRIMARY KEY,
+                docs INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS docs (
+                date TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                group_id TEXT NOT NULL,
+                group_name TEXT NOT NULL,
+                sender_id TEXT NOT NULL,
+                sender_name TEXT NOT NULL,
+                text_message TEXT NOT NULL,
+                PRIMARY KEY (date, doc_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (
+                token TEXT NOT NULL,
+                date TEXT NOT NULL,
+                group_id TEXT NOT NULL,
+                entries BLOB NOT NULL,
+                PRIMARY KEY (token, date, group_id)
+            ) WITHOUT ROWID;
+        """)
+        self._conn.commit()
+        self.date = None
+        self._today = None
+        self._unsaved = {}
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    @staticmethod
+    def new_day():
+        # docs: 按 MESSAGE_COLUMNS 顺序的消息; postings: {词项: {群号: array('I')}}
+        return {'docs': [], 'postings': {}}
+
+    @staticmethod
+    def add_doc(day, row):
+        doc_id = len(day['docs'])
+        doc = [row.get(column) or '' for column in MESSAGE_COLUMNS]
+        day['docs'].append(doc)
+        counts = {}
+        for token in tokenize_text(doc[5]):
+            counts[token] = counts.get(token, 0) + 1
+        postings = day['postings']
+        for token, count in counts.items():
+            groups = postings.get(token)
+            if groups is None:
+                groups = postings[token] = {}
+            entries = groups.get(doc[1])
+            if entries is None:
+                entries = groups[doc[1]] = array('I')
+            entries.append(doc_id)
+            entries.append(count)
+
+    @classmethod
+    def build(cls, rows):
+        day = cls.new_day()
+        for row in rows:
+            cls.add_doc(day, row)
+        return day
+
+    def reset(self, date, rows=()):
+        """用今天已有的消息重建今天的索引"""
+        self.date = date
+        self._today = self.build(rows)
+
+    def add(self, row):
+        """加入一条消息, 日期变化时把前一天的索引转为待保存"""
+        date = row_date(row['timestamp'])
+        if date != self.date:
+            if self.date is not None and date < self.date:
+                return
+            if self._today is not None and self.date is not None:
+                self._unsaved[self.date] = self._today
+            self.date = date
+            self._today = self.new_day()
+        self.add_doc(self._today, row)
+
+    def save_day_sync(self, date, day):
+        """把一天的索引写入数据库(替换已有内容)"""
+        with self._conn:
+            self._conn.execute('DELETE FROM docs WHERE date = ?', (date,))
+            self._conn.execute('DELETE FROM postings WHERE date = ?', (date,))
+            self._conn.execute('INSERT OR REPLACE INTO days (date, docs) VALUES (?, ?)', (date, len(day['docs'])))
+            self._conn.executemany(
+                'INSERT INTO docs (date, doc_id, timestamp, group_id, group_name, sender_id, sender_name, '
+                'text_message) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((date, doc_id, *doc) for doc_id, doc in enumerate(day['docs'])))
+            self._conn.executemany(
+                'INSERT INTO postings (token, date, group_id, entries) VALUES (?, ?, ?, ?)',
+                ((token, date, group_id, entries.tobytes())
+                 for token, groups in day['postings'].items()
+                 for group_id, entries in groups.items()))
+
+    async def save_unsaved(self):
+        """保存已结束日期的索引, 返回保存的 {日期: 消息条数}"""
+        saved = {}
+        while self._unsaved:
+            date, day = next(iter(self._unsaved.items()))
+            await self._run(self.save_day_sync, date, day)
+            del self._unsaved[date]
+            saved[date] = len(day['docs'])
+        return saved
+
+    async def indexed_dates(self, start_date, end_date):
+        """日期范围内已经建立索引的日期"""
+        def query():
+            rows = self._conn.execute(
+                'SELECT date FROM days WHERE date BETWEEN ? AND ?', (start_date, end_date)).fetchall()
+            return {row[0] for row in rows}
+
+        return await self._run(query)
+
+    async def build_day(self, date, rows):
+        """为历史日期建立索引并保存"""
+        await self._run(lambda: self.save_day_sync(date, self.build(rows)))
+
+    @staticmethod
+    def _collect(entries, date, counts, df):
+        """把倒排表中的 [消息序号, 词频, ...] 合并到 {(日期, 消息序号): 词频}"""
+        counts.update(((date, entries[i]), entries[i + 1]) for i in range(0, len(entries), 2))
+        df[date] = df.get(date, 0) + len(entries) // 2
+
+    @staticmethod
+    def _score(per_token, day_docs):
+        """对同时包含全部词项的消息按 tf-idf 打分, 返回 [(得分, 日期, 消息序号)]"""
+        if not per_token or any(not counts for counts, _ in per_token):
+            return []
+        per_token = sorted(per_token, key=lambda item: len(item[0]))
+        candidates = set(per_token[0][0])
+        for counts, _ in per_token[1:]:
+            candidates.intersection_update(counts.keys())
+            if not candidates:
+                return []
+        hits = []
+        for key in candidates:
+            date = key[0]
+            score = 0.0
+            for counts, df in per_token:
+                score += math.log(1 + day_docs[date] / df[date]) * (1 + math.log(counts[key]))
+            hits.append((score, date, key[1]))
+        return hits
+
+    def search_today(self, tokens, group_id=None):
+        """在今天的内存索引中检索(在事件循环线程中调用)"""
+        day = self._today
+        if day is None:
+            return []
+        per_token = []
+        for token in tokens:
+            counts, df = {}, {}
+            for entry_group, entries in day['postings'].get(token, {}).items():
+                if group_id and entry_group != group_id:
+                    continue
+                self._collect(entries, self.date, counts, df)
+            per_token.append((counts, df))
+        return self._score(per_token, {self.date: len(day['docs'])})
+
+    async def search_saved(self, tokens, start_date, end_date, group_id=None):
+        """在数据库中检索日期范围(含两端)内的消息"""
+        def query():
+            per_token = []
+            for token in tokens:
+                sql = 'SELECT date, entries FROM postings WHERE token = ? AND date BETWEEN ? AND ?'
+                params = [token, start_date, end_date]
+                if group_id:
+                    sql += ' AND group_id = ?'
+                    params.append(group_id)
+                counts, df = {}, {}
+                for date, blob in self._conn.execute(sql, params):
+                    entries = array('I')
+                    entries.frombytes(blob)
+                    self._collect(entries, date, counts, df)
+                if not counts:
+                    return []
+                per_token.append((counts, df))
+            day_docs = dict(self._conn.execute(
+                'SELECT date, docs FROM days WHERE date BETWEEN ? AND ?', (start_date, end_date)).fetchall())
+            return self._score(per_token, day_docs)
+
+        return await self._run(query)
+
+    async def fetch_docs(self, keys):
+        """按 (日期, 消息序号) 读取消息, 返回 {(日期, 消息序号): 按 MESSAGE_COLUMNS 顺序的列表}"""
+        docs = {}
+        saved_keys = []
+        for date, doc_id in keys:
+            if date == self.date and self._today is not None:
+                docs[(date, doc_id)] = self._today['docs'][doc_id]
+            elif date in self._unsaved:
+                docs[(date, doc_id)] = self._unsaved[date]['docs'][doc_id]
+            else:
+                saved_keys.append((date, doc_id))
+
+        def query():
+            found = {}
+            for date, doc_id in saved_keys:
+                row = self._conn.execute(
+                    f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM docs WHERE date = ? AND doc_id = ?",
+                    (date, doc_id)).fetchone()
+                if row is not None:
+                    found[(date, doc_id)] = list(row)
+            return found
+
+        if saved_keys:
+            docs.update(await self._run(query))
+        return docs
+
+    async def close(self):
+        """保存尚未保存的索引并关闭数据库"""
+        await self.save_unsaved()
+        await self._run(self._conn.close)
+        self.executor.shutdown(wait=False)
+
+
+class PartialCompletionError(Exception):
+    """流式输出已经开始后出错, content 为已经生成的内容"""
+
+    def __init__(self, content):
+        super().__init__(f'流式输出中断, 已生成 {len(content)} 字')
+        self.content = content
+
+
+class ReplySectionSender:
+    """把流式生成的总结按段落分批回复, 每次至少 min_chars 字, 第一条带上标题"""
+
+    def __init__(self, reply, title, min_chars=300):
+        self.reply = reply
+        self.title = title
+        self.min_chars = min_chars
+        self.buffer = ''
+        self.sent = False
+
+    async def send(self, text):
+        if not self.sent:
+            text = f"{self.title}\n{text}"
+            self.sent = True
+        await self.reply(text)
+
+    async def feed(self, delta):
+        """接收一段生成的文本, 在最后一个空行处切分出完整的段落"""
+        self.buffer += delta
+        cut = self.buffer.rfind('\n\n')
+        if cut >= self.min_chars:
+            await self.send(self.buffer[:cut])
+            self.buffer = self.buffer[cut + 2:]
+
+    async def finish(self, result):
+        """生成结束: 还没有回复过时回复完整结果(包括出错时的提示), 否则回复剩余部分"""
+        if not self.sent:
+            await self.send(result)
+        elif self.buffer.strip():
+            await self.send(self.buffer.strip())
+        self.buffer = ''
+
+
+class MessageBroadcaster:
+    """把新收到的消息推送给 /messages/stream 的订阅者
+
+    每个订阅者有一个有界队列, 队列满时清空并放入 None 使其断开, 客户端重连时
+    用 Last-Event-ID 从最近消息的环形缓冲中补发。事件编号带有启动时间前缀,
+    插件重启后旧的编号不会被误认为有效。
+    """
+
+    def __init__(self, history=1000, queue_size=1000):
+        self.epoch = str(int(time.time()))
+        self.history = deque(maxlen=history)
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.last_id = 0
+
+    def event_id(self, number):
+        return f'{self.epoch}-{number}'
+
+    def publish(self, row):
+        self.last_id += 1
+        event = (self.last_id, row)
+        self.history.append(event)
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except asyncio.QueueFull:
+                # 订阅者处理不过来, 断开后由客户端重连补发
+                self.subscribers.discard(subscriber)
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(None)
+
+    def subscribe(self, last_event_id=None):
+        """订阅新消息, last_event_id 有效时先补发其后的消息"""
+        subscriber = asyncio.Queue(maxsize=self.queue_size)
+        if last_event_id:
+            epoch, _, number = last_event_id.partition('-')
+            if epoch == self.epoch and number.isdigit():
+                for event in self.history:
+                    if event[0] > int(number) and not subscriber.full():
+                        subscriber.put_nowait(event)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def close(self):
+        for subscriber in list(self.subscribers):
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            subscriber.put_nowait(None)
+        self.subscribers.clear()
+
 
 @register(name="ChatAnalyzer", description="群聊分析插件", version="0.1", author="作者名")
 class ChatAnalyzerPlugin(BasePlugin):
@@ -22,73 +2867,294 @@ class ChatAnalyzerPlugin(BasePlugin):
         try:
             # 设置数据目录
             self.data_dir = os.path.join('/app/data/chat_analyzer')
-            print(f"数据目录设置为: {self.data_dir}")
+            
+            # 初始化配置项
+            self.init_settings()
+            
+            # 日志交给后台线程输出, 不阻塞事件循环
+            self.log_listener = setup_logging(self.log_level, self.log_sample_every, self.log_max_length)
+            configure_tokenizer(self.prompt_tokenizer)
+            logger.info("数据目录设置为: %s", self.data_dir)
             
             # 确保目录存在
             os.makedirs(self.data_dir, exist_ok=True)
             
+            # 初始化消息存储和已结束日期的压缩归档
+            self.log_archive = DailyLogArchive(
+                self.data_dir,
+                block_rows=self.archive_block_rows,
+                compress_level=self.archive_compress_level
+            )
+            self.last_compaction = None
+            self.data_dir_size = None
+            self.message_store = self.create_message_store()
+            # 导入CSV记录和预热缓存完成后才开始处理消息
+            self.store_ready = asyncio.Event()
+            
             # 初始化文件路径
             self.init_paths()
             
-            # 启动定时任务
+            # 启动消息批量写入器
+            self.ingest_writer = IngestWriter(
+                self.message_store,
+                batch_size=self.ingest_batch_size,
+                flush_interval=self.ingest_flush_interval,
+                max_pending=self.ingest_max_pending
+            )
+            self.ingest_writer.start()
+            
+            # 初始化最近消息缓存
+            self.recent_cache = RecentMessageCache(
+                group_depth=self.recent_group_depth,
+                user_depth=self.recent_user_depth,
+                max_total=self.recent_max_messages
+            )
+            # 大模型和HTTP客户端在插件生命周期内复用
+            self.llm_client = None
+            self.http_session = None
+            self.llm_limiter = RateLimiter(self.llm_requests_per_minute, self.llm_tokens_per_minute)
+            self.feishu_limiter = RateLimiter(self.feishu_requests_per_minute, burst=self.feishu_burst)
+            self.last_daily_run = None
+            
+            # 群聊命令的并发合并与结果缓存, 以及各群的数据版本号
+            self.command_cache = SingleFlightCache(ttl=self.command_cache_ttl)
+            self.group_versions = {}
+            
+            # 初始化总结存储, 并迁移旧版的 summary.csv
+            self.summary_store = SummaryStore(self.summary_dir)
+            migrated = self.summary_store.migrate_legacy(self.summary_path)
+            if migrated:
+                storage_logger.info("已把 %d 条旧总结迁移到按天分区的存储", migrated)
+            
+            # 初始化用户画像存储
+            self.profile_store = UserProfileStore(self.user_profile_dir)
+            
+            # 初始化群目录
+            self.group_catalog = GroupCatalog(os.path.join(self.data_dir, 'groups.json'))
+            
+            # 初始化群活跃统计
+            self.activity_stats = ActivityStats(os.path.join(self.data_dir, 'stats'), self.stats_cache_days)
+            
+            # 初始化全文检索索引
+            self.search_index = SearchIndex(os.path.join(self.data_dir, 'search.db'))
+            
+            # 新消息的实时推送
+            self.message_broadcaster = MessageBroadcaster(self.web_stream_history, self.web_stream_queue_size)
+            
+            # 飞书通知发件箱, 由后台任务推送
+            self.feishu_outbox = FeishuOutbox(
+                os.path.join(self.data_dir, 'outbox'),
+                self.post_feishu,
+                batch_size=self.feishu_batch_size,
+                batch_delay=self.feishu_batch_delay,
+                batch_max_bytes=self.feishu_batch_max_bytes,
+                max_attempts=self.feishu_max_attempts,
+                retry_base_delay=self.feishu_retry_base_delay,
+                retry_max_delay=self.feishu_retry_max_delay
+            )
+            if self.feishu_webhook_url.startswith('http'):
+                self.feishu_outbox.start()
+            else:
+                logger.warning("未配置飞书webhook地址, 通知只保存在发件箱中")
+            
+            # 在后台准备消息存储并补做之前没有完成的归档, 然后启动定时任务; 插件卸载时取消这些任务
+            self.background_tasks = [asyncio.create_task(self.prepare_store())]
+            self.web_runner = None
             self.start_daily_task()
+            self.start_checkpoint_task()
             
             # 确保模板目录存在
             template_dir = os.path.join(os.path.dirname(__file__), 'templates')
             static_dir = os.path.join(os.path.dirname(__file__), 'static')
             os.makedirs(template_dir, exist_ok=True)
             os.makedirs(static_dir, exist_ok=True)
-            print(f"模板目录: {template_dir}")
-            print(f"静态文件目录: {static_dir}")
+            web_logger.info("模板目录: %s", template_dir)
+            web_logger.info("静态文件目录: %s", static_dir)
             
             # 启动Web服务
-            print("正在启动Web服务...")
-            asyncio.create_task(self.start_web_server())
-            print("Web服务启动任务已创建")
+            web_logger.info("正在启动Web服务...")
+            self.background_tasks.append(asyncio.create_task(self.start_web_server()))
+            web_logger.info("Web服务启动任务已创建")
             
         except Exception as e:
-            print(f"初始化插件时发生错误: {traceback.format_exc()}")
+            logger.exception("初始化插件时发生错误")
+
+    async def destroy(self):
+        """插件卸载时停止后台任务, 写入尚未落盘的消息, 保存内存中的数据并关闭连接"""
+        for task in getattr(self, 'background_tasks', []):
+            task.cancel()
+        for name in ('feishu_outbox', 'message_broadcaster'):
+            component = getattr(self, name, None)
+            if component is not None:
+                component.close()
+        if getattr(self, 'web_runner', None) is not None:
+            await self.web_runner.cleanup()
+            self.web_runner = None
+        writer = getattr(self, 'ingest_writer', None)
+        if writer is not None:
+            try:
+                await writer.close()
+            except Exception:
+                logger.exception("卸载插件时写入消息出错")
+        if hasattr(self, 'search_index'):
+            try:
+                self.checkpoint()
+                await self.search_index.close()
+            except Exception:
+                logger.exception("卸载插件时保存数据出错")
+        await self.close_clients()
+        listener = getattr(self, 'log_listener', None)
+        if listener is not None:
+            stop_logging(listener)
+
+    def init_settings(self):
+        """初始化配置项"""
+        # 消息批量写入: 每批最大条数、最长等待秒数、最大积压条数
+        self.ingest_batch_size = 200
+        self.ingest_flush_interval = 0.5
+        self.ingest_max_pending = 10000
+        # 最近消息缓存: 每个群/每个用户保留条数, 全局最大条数
+        self.recent_group_depth = 500
+        self.recent_user_depth = 100
+        self.recent_max_messages = 100000
+        # 消息存储后端: csv(按天分文件) / sqlite(带索引的数据库)
+        self.storage_backend = 'csv'
+        # /search 接口: 默认每页条数、最大每页条数、最多查询天数
+        self.search_page_size = 20
+        self.search_max_page_size = 100
+        self.search_max_days = 31
+        # 跨天查询时并行扫描的线程数
+        self.range_query_workers = 4
+        # 是否在每日任务中把已结束日期的消息记录压缩归档
+        self.archive_enabled = True
+        # 归档中每个压缩块包含的消息条数, 越小随机读取越快, 压缩率越低
+        self.archive_block_rows = 2000
+        # gzip 压缩级别(1-9)
+        self.archive_compress_level = 6
+        # /messages 接口: 默认每页条数、最大每页条数、每批读取条数
+        self.messages_page_size = 500
+        self.messages_max_page_size = 5000
+        self.messages_scan_batch = 200
+        # /summaries 接口: 默认每页条数、最大每页条数
+        self.summaries_page_size = 50
+        self.summaries_max_page_size = 500
+        # 内存数据(群目录等)保存到磁盘的间隔秒数
+        self.checkpoint_interval = 60
+        # 大模型接口
+        self.llm_base_url = "YOUR_API_BASE_URL"
+        self.llm_api_key = "YOUR_API_KEY"
+        self.llm_model = "gemini-2.0-flash"
+        self.llm_max_tokens = 2000
+        # 大模型调用失败时的重试次数和指数退避的初始/最大等待秒数
+        self.llm_max_retries = 3
+        self.llm_retry_base_delay = 1
+        self.llm_retry_max_delay = 30
+        # 大模型限流: 每分钟请求数和token数
+        self.llm_requests_per_minute = 60
+        self.llm_tokens_per_minute = 500000
+        # 每日总结同时处理的群数
+        self.summary_concurrency = 8
+        # 群聊总结方式: single(只总结最新的消息) / map_reduce(分块总结全天消息后汇总)
+        self.summary_mode = 'map_reduce'
+        # 分块总结: 每块token数、最多块数(超出时抽样)、同时总结的块数、
+        # 每块要点的最大输出token数、每次合并的要点数
+        self.summary_chunk_tokens = 6000
+        self.summary_max_chunks = 24
+        self.summary_map_concurrency = 4
+        self.summary_partial_max_tokens = 800
+        self.summary_reduce_fanin = 8
+        # 分块总结: 分块前划分时间窗口的分钟数、各块要点缓存的保留天数
+        self.summary_window_minutes = 60
+        self.summary_cache_days = 7
+        # "总结 N" 命令最多总结的天数
+        self.summary_max_days = 30
+        # 提示词: 计算token数使用的 tiktoken 编码(为空时估算)、一次总结的token预算和读取的最新消息条数
+        self.prompt_tokenizer = ''
+        self.summary_prompt_tokens = 4000
+        self.summary_recent_messages = 500
+        # 提示词压缩: 单条消息最大字数、昵称最大字数、合并重复消息的分钟数、合并同一人连续消息的分钟数
+        self.prompt_max_message_chars = 300
+        self.prompt_name_max_chars = 8
+        self.prompt_dedup_minutes = 10
+        self.prompt_merge_minutes = 3
+        # "总结"命令是否边生成边按段落回复, 以及每次回复的最少字数
+        self.summary_stream_reply = True
+        self.reply_section_min_chars = 300
+        # 总结时是否在提示词中附带按全部消息统计的活跃数据
+        self.summary_include_stats = True
+        # 活跃统计: 内存中保留的天数、/stats 最多查询天数、发言最多成员的条数
+        self.stats_cache_days = 31
+        self.stats_max_days = 366
+        self.stats_top_posters = 10
+        # 用户画像: 首次生成时读取的天数, 每批最多使用的消息条数和token数, 每次命令最多合并的批数
+        self.profile_history_days = 7
+        self.profile_max_messages = 200
+        self.profile_prompt_tokens = 8000
+        self.profile_max_rounds = 3
+        # 相同群聊命令结果的缓存秒数(群里有新消息时立即失效)
+        self.command_cache_ttl = 300
+        # 飞书机器人
+        self.feishu_webhook_url = "YOUR_FEISHU_WEBHOOK_URL"
+        self.feishu_timeout = 10
+        # 飞书推送限流: 每分钟请求数和最多连续发出的请求数(飞书自定义机器人限制为每分钟100次、每秒5次)
+        self.feishu_requests_per_minute = 100
+        self.feishu_burst = 5
+        # 被飞书限流且响应中没有 Retry-After 时暂停推送的秒数
+        self.feishu_rate_limit_pause = 30
+        # 多条通知合并为一张卡片: 每张最多条数(1 表示不合并)、凑满一批最多等待的秒数、消息体最大字节数
+        self.feishu_batch_size = 1
+        self.feishu_batch_delay = 10
+        self.feishu_batch_max_bytes = 18000
+        # 推送失败后的最多尝试次数, 以及指数退避的初始/最大等待秒数
+        self.feishu_max_attempts = 20
+        self.feishu_retry_base_delay = 5
+        self.feishu_retry_max_delay = 1800
+        # /metrics 中数据目录大小的统计间隔秒数
+        self.metrics_dir_size_interval = 300
+        # Web管理界面的端口和访问密码
+        self.web_port = 3300
+        self.web_password = "YOUR_PASSWORD"
+        # 响应体超过该字节数时按 Accept-Encoding 压缩, 安装了 brotli 时优先使用 br 及其压缩级别
+        self.web_compress_min_size = 1024
+        self.web_brotli_quality = 5
+        # /messages/stream 实时推送: 最大连接数、心跳间隔秒数、用于补发的最近消息条数、每个连接的队列长度
+        self.web_stream_max_clients = 50
+        self.web_stream_heartbeat = 15
+        self.web_stream_history = 1000
+        self.web_stream_queue_size = 1000
+        # 日志级别, DEBUG 时会输出提示词、生成结果等详细内容
+        self.log_level = 'INFO'
+        # 按分类抽样输出日志, 每 N 条只输出一条(WARNING 及以上总是输出)
+        self.log_sample_every = {'ingest': 100}
+        # 单条日志的最大长度, 超出部分截断
+        self.log_max_length = 2000
+
+    def create_message_store(self):
+        """根据配置创建消息存储后端"""
+        if self.storage_backend == 'sqlite':
+            # 已有CSV记录的一次性导入由 prepare_store 在后台完成
+            store = SqliteMessageStore(os.path.join(self.data_dir, 'messages.db'))
+        else:
+            store = CsvMessageStore(self.data_dir, self.range_query_workers, self.log_archive)
+        storage_logger.info("消息存储后端: %s", store.name)
+        return store
 
     def init_paths(self):
         """初始化各种文件路径"""
         current_date = datetime.now().strftime("%Y%m%d")
         # 每日消息记录
+        self.log_date = current_date
         self.daily_log_path = os.path.join(self.data_dir, f'daily_{current_date}.csv')
         # 用户画像数据
         self.user_profile_dir = os.path.join(self.data_dir, 'user_profiles')
         os.makedirs(self.user_profile_dir, exist_ok=True)
-        # 总结历史记录
+        # 分块总结的时间窗口要点缓存
+        self.summary_cache_dir = os.path.join(self.data_dir, 'summary_cache')
+        # 总结历史记录(按天分区), 以及需要迁移的旧版单文件
+        self.summary_dir = os.path.join(self.data_dir, 'summaries')
         self.summary_path = os.path.join(self.data_dir, 'summary.csv')
         
-        print(f"日志文件路径: {self.daily_log_path}")
-        
-        # 如果日志文件不存在,创建并写入表头
-        if not os.path.exists(self.daily_log_path):
-            with open(self.daily_log_path, 'w', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    'timestamp',
-                    'group_id',
-                    'group_name', 
-                    'sender_id',
-                    'sender_name',
-                    'text_message',
-                    'raw_data'
-                ])
-            print(f"创建新的日志文件: {self.daily_log_path}")
-            
-        # 如果总结文件不存在,创建并写入表头    
-        if not os.path.exists(self.summary_path):
-            with open(self.summary_path, 'w', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    'timestamp',
-                    'group_id',
-                    'summary_type',  # auto/manual
-                    'content',
-                    'source_date'
-                ])
-            print(f"创建新的总结文件: {self.summary_path}")
+        storage_logger.info("日志文件路径: %s", self.daily_log_path)
 
     def start_daily_task(self):
         """启动每日定时任务"""
@@ -103,233 +3169,812 @@ class ChatAnalyzerPlugin(BasePlugin):
                 try:
                     # 执行每日总结
                     await self.daily_summary()
+                    # 清理过期的总结缓存
+                    self.cleanup_window_cache()
                     # 更新文件路径
                     self.init_paths()
+                    # 命令缓存的键包含日期, 换天后旧的版本号不再使用, 顺便清掉已经不活跃的群
+                    self.group_versions.clear()
+                    # 保存昨天的检索索引, 压缩归档已结束日期的消息记录
+                    await self.save_search_index()
+                    await self.compact_logs()
                 except Exception as e:
-                    print(f"执行每日任务时出错: {traceback.format_exc()}")
+                    logger.exception("执行每日任务时出错")
+
+        self.background_tasks.append(asyncio.create_task(daily_task()))
+        logger.info("已启动每日定时任务")
+
+    async def compact_logs(self):
+        """把今天之前的原始CSV消息记录压缩归档, 在线程池中逐天执行"""
+        if not self.archive_enabled:
+            return []
+        try:
+            if self.message_store.name == 'sqlite':
+                # 归档前确保这些记录已经导入数据库
+                await self.message_store.import_csv(self.data_dir, self.log_archive)
+            loop = asyncio.get_event_loop()
+            results = []
+            for date in self.log_archive.pending_dates(self.log_date):
+                # 写完缓冲区中的消息并关闭该天的文件, 归档期间暂停落盘,
+                # 避免迟到的消息写入已被删除的文件而丢失
+                async with self.ingest_writer.paused():
+                    await self.message_store.close_day(date)
+                    stats = await loop.run_in_executor(None, self.log_archive.compact, date)
+                storage_logger.info("已归档 %s: %d 条消息, %d -> %d 字节, 压缩比 %s",
+                                    date, stats['rows'], stats['raw_size'], stats['size'], stats['ratio'])
+                results.append(stats)
+            if results:
+                self.last_compaction = {
+                    'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'days': results
+                }
+            return results
+        except Exception as e:
+            storage_logger.exception("归档消息记录出错")
+            return []
+
+    def start_checkpoint_task(self):
+        """启动定期保存任务"""
+        async def checkpoint_task():
+            while True:
+                await asyncio.sleep(self.checkpoint_interval)
+                try:
+                    self.checkpoint()
+                    await self.save_search_index()
+                except Exception as e:
+                    logger.exception("保存数据时出错")
+
+        self.background_tasks.append(asyncio.create_task(checkpoint_task()))
+
+    def checkpoint(self):
+        """把内存中的数据保存到磁盘"""
+        self.group_catalog.save()
+        self.activity_stats.save()
+
+    async def prepare_store(self):
+        """插件启动时在后台准备消息存储
+
+        使用 sqlite 时先导入已有的CSV记录, 然后预热缓存, 完成后才开始处理消息,
+        最后补做之前没有完成的归档。导入期间其他读取在数据库线程中排队等待, 不阻塞事件循环。
+        """
+        if self.message_store.name == 'sqlite':
+            try:
+                total = await self.message_store.import_csv(self.data_dir, self.log_archive)
+                if total:
+                    storage_logger.info("CSV记录导入完成, 共 %d 条消息", total)
+            except Exception as e:
+                storage_logger.exception("导入CSV记录出错")
+        await self.warm_caches()
+        self.store_ready.set()
+        await self.compact_logs()
+
+    async def warm_caches(self):
+        """从今天的消息记录预热最近消息缓存、今天的检索索引和活跃统计, 必要时重建今天的群目录"""
+        rebuild_catalog = not self.group_catalog.has_day(self.log_date)
+        try:
+            rows = await self.message_store.read_day(self.log_date)
+            # 读取完成后再切换缓存的日期, 在此之前读取缓存的请求会转而读取存储
+            self.recent_cache.reset(self.log_date)
+            for row in rows:
+                self.recent_cache.add(row)
+            if rebuild_catalog:
+                self.group_catalog.rebuild_day(self.log_date, rows)
+            self.search_index.reset(self.log_date, rows)
+            self.activity_stats.catch_up(self.log_date, rows)
+            logger.info("已从今日记录预热 %d 条消息到缓存", self.recent_cache.total)
+        except Exception as e:
+            logger.exception("预热消息缓存错误")
+
+    async def save_search_index(self):
+        """保存已结束日期的检索索引"""
+        for date, docs in (await self.search_index.save_unsaved()).items():
+            logger.info("已保存 %s 的检索索引: %d 条消息", date, docs)
+
+    async def ensure_search_days(self, start_date, end_date):
+        """为日期范围内还没有索引的历史日期建立索引"""
+        end_date = min(end_date, (datetime.strptime(self.log_date, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d'))
+        if start_date > end_date:
+            return
+        await self.save_search_index()
+        indexed = await self.search_index.indexed_dates(start_date, end_date)
+        for date in date_range(start_date, end_date):
+            # 索引所在的当天(日期切换后还没有新消息时为昨天)仍在内存中
+            if date in indexed or date == self.search_index.date:
+                continue
+            rows = await self.message_store.read_day(date)
+            await self.search_index.build_day(date, rows)
+            if rows:
+                logger.info("已为 %s 建立检索索引: %d 条消息", date, len(rows))
+
+    async def search_messages(self, query, group_id=None, start_date=None, end_date=None):
+        """在日期范围(含两端)内检索包含全部查询词的消息
 
-        asyncio.create_task(daily_task())
-        print("已启动每日定时任务")
+        返回按得分从高到低(同分时新消息在前)排序的 [(得分, 日期, 消息序号)],
+        消息内容用 search_index.fetch_docs 读取。
+        """
+        tokens = list(dict.fromkeys(tokenize_text(query)))
+        if not tokens:
+            return []
+        end_date = end_date or self.log_date
+        start_date = start_date or end_date
+        await self.ensure_search_days(start_date, end_date)
+        hits = await self.search_index.search_saved(tokens, start_date, end_date, group_id)
+        if self.search_index.date and start_date <= self.search_index.date <= end_date:
+            hits.extend(self.search_index.search_today(tokens, group_id))
+        hits.sort(reverse=True)
+        return hits
+
+    async def get_groups(self, date=None):
+        """获取群目录, 目录中没有的历史日期从消息记录重建"""
+        if date is not None and date <= self.log_date and not self.group_catalog.has_day(date):
+            rows = await self.message_store.read_day(date)
+            self.group_catalog.rebuild_day(date, rows)
+        return self.group_catalog.groups(date)
+
+    async def get_activity_stats(self, start_date, end_date, group_id=None, sender_id=None, top=None):
+        """汇总日期范围(含两端)内的活跃统计, 没有统计的历史日期从消息记录统计"""
+        dates = date_range(start_date, min(end_date, self.log_date))
+        for date in dates:
+            if date < self.log_date and not self.activity_stats.has_day(date):
+                rows = await self.message_store.read_day(date)
+                self.activity_stats.rebuild_day(date, rows)
+        return self.activity_stats.report(dates, group_id, sender_id, top or self.stats_top_posters)
+
+    async def activity_stats_text(self, group_id, start_date, end_date):
+        """总结提示词中附带的活跃统计, 出错时不影响总结"""
+        if not self.summary_include_stats:
+            return ''
+        try:
+            report = await self.get_activity_stats(start_date, end_date, group_id)
+            return format_activity_stats(report)
+        except Exception as e:
+            logger.exception("统计群活跃数据错误")
+            return ''
 
     async def get_chat_history(self, group_id, limit=100):
-        """获取群聊历史记录"""
-        messages = []
-        try:
-            if not os.path.exists(self.daily_log_path):
-                print(f"日志文件不存在: {self.daily_log_path}")
-                return messages
-
-            async with aiofiles.open(self.daily_log_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                for row in csv.DictReader(content.splitlines()):
-                    if row['group_id'] == group_id:
-                        messages.append(row)
-                        if len(messages) >= limit:
-                            break
-            print(f"获取到 {len(messages)} 条群聊记录")
-        except Exception as e:
-            print(f"读取历史记录错误: {traceback.format_exc()}")
+        """获取群聊最新的历史记录"""
+        started = time.perf_counter()
+        cached = self.recent_cache.latest(self.log_date, group_id, limit)
+        if cached is not None:
+            logger.debug("从缓存获取到 %d 条群聊记录", len(cached))
+            observe_history_read('chat_history', 'cache', len(cached), started)
+            return cached
+        messages = await self.read_latest_messages(limit, group_id)
+        logger.debug("获取到 %d 条群聊记录", len(messages))
+        observe_history_read('chat_history', 'store', len(messages), started)
         return messages
 
     async def get_user_messages(self, group_id, user_id, limit=50):
-        """获取用户的历史消息"""
-        messages = []
-        try:
-            if not os.path.exists(self.daily_log_path):
-                print(f"日志文件不存在: {self.daily_log_path}")
-                return messages
-
-            async with aiofiles.open(self.daily_log_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                for row in csv.DictReader(content.splitlines()):
-                    if row['group_id'] == group_id and row['sender_id'] == user_id:
-                        messages.append(row)
-                        if len(messages) >= limit:
-                            break
-            print(f"获取到 {len(messages)} 条用户消息")
-        except Exception as e:
-            print(f"读取用户消息错误: {traceback.format_exc()}")
+        """获取用户最新的历史消息"""
+        started = time.perf_counter()
+        cached = self.recent_cache.latest_user(self.log_date, group_id, user_id, limit)
+        if cached is not None:
+            logger.debug("从缓存获取到 %d 条用户消息", len(cached))
+            observe_history_read('user_messages', 'cache', len(cached), started)
+            return cached
+        messages = await self.read_latest_messages(limit, group_id, user_id)
+        logger.debug("获取到 %d 条用户消息", len(messages))
+        observe_history_read('user_messages', 'store', len(messages), started)
+        return messages
+
+    async def read_latest_messages(self, limit, group_id, sender_id=None):
+        """从消息存储读取当天满足条件的最新 limit 条消息"""
+        try:
+            # 先写入缓冲区中的消息
+            await self.ingest_writer.flush()
+            return await self.message_store.latest(self.log_date, limit, group_id, sender_id)
+        except Exception as e:
+            storage_logger.exception("读取历史记录错误")
+            return []
+
+    async def get_user_messages_since(self, group_id, user_id, mark):
+        """获取用户在高水位之后的全部消息, 没有高水位时读取最近几天的消息
+
+        返回 UserProfileStore.after_mark 的结果, 即 [(消息, 该消息是用户当天的第几条)]。
+        """
+        started = time.perf_counter()
+        if mark:
+            start_date = UserProfileStore.mark_date(mark)
+            # 高水位在今天且缓存中有该用户今天的全部消息时, 直接使用缓存
+            if start_date == self.log_date:
+                cached = self.recent_cache.latest_user(
+                    self.log_date, group_id, user_id, self.recent_user_depth)
+                if cached is not None and len(cached) < self.recent_user_depth:
+                    messages = UserProfileStore.after_mark(cached, mark)
+                    observe_history_read('user_since', 'cache', len(messages), started)
+                    return messages
+        else:
+            start_date = (datetime.now() - timedelta(days=self.profile_history_days - 1)).strftime("%Y%m%d")
+        await self.ingest_writer.flush()
+        messages = await self.message_store.read_written(start_date, self.log_date, group_id, user_id)
+        messages = UserProfileStore.after_mark(messages, mark)
+        observe_history_read('user_since', 'store', len(messages), started)
         return messages
 
-    async def summarize_messages(self, messages, prompt_type="daily"):
-        """使用AI总结消息"""
+    def profile_batch(self, pending):
+        """从最早的消息开始取出一批不超过条数和token预算的消息, 返回 (条数, 提示词行)"""
+        count = min(len(pending), self.profile_max_messages)
+        while True:
+            lines = self.prompt_lines([msg for msg, _ in pending[:count]])
+            tokens = sum(estimate_tokens(line) for line in lines)
+            if tokens <= self.profile_prompt_tokens or count == 1:
+                return count, ''.join(lines)
+            # 按超出的比例减少条数, 保证每次至少减少一条
+            count = min(count - 1, max(1, count * self.profile_prompt_tokens // tokens))
+
+    async def build_user_profile(self, group_id, user_id):
+        """生成或增量更新用户画像, 返回 (画像内容, 是否有更新)
+
+        已有画像且没有新消息时直接返回已有画像; 有新消息时从最早的一条开始按预算分批合并进
+        画像, 高水位只推进到最后一条实际合并的消息, 本次没有合并完的消息留到下次。
+        """
+        try:
+            stored = self.profile_store.load(group_id, user_id)
+        except Exception as e:
+            storage_logger.exception("读取用户画像错误")
+            stored = None
+        mark = stored.get('high_water') if stored else None
+
+        pending = await self.get_user_messages_since(group_id, user_id, mark)
+        logger.debug("用户 %s 有 %d 条新消息", user_id, len(pending))
+        if stored and not pending:
+            return stored['profile'], False
+        if not pending:
+            return "没有找到需要总结的消息", False
+
+        profile = stored['profile'] if stored else None
+        merged = []
+        for _ in range(self.profile_max_rounds):
+            if len(merged) == len(pending):
+                break
+            count, lines = self.profile_batch(pending[len(merged):])
+            if profile:
+                user_prompt = PROFILE_MERGE_PROMPT.format(profile=profile) + lines
+            else:
+                user_prompt = "请深入分析该用户的特征:\n\n" + lines
+            result = await self.call_llm(PROFILE_SYSTEM_PROMPT, user_prompt)
+            if not result:
+                break
+            profile = result
+            merged = pending[:len(merged) + count]
+        if not merged:
+            return (stored['profile'] if stored else LLM_FAILED_REPLY), False
+        if len(merged) < len(pending):
+            logger.info("用户 %s 还有 %d 条消息未合并进画像", user_id, len(pending) - len(merged))
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        record = {
+            'group_id': group_id,
+            'user_id': user_id,
+            'sender_name': merged[-1][0].get('sender_name', '') or (stored or {}).get('sender_name', ''),
+            'profile': profile,
+            'high_water': UserProfileStore.advance_mark(mark, merged),
+            'message_count': (stored or {}).get('message_count', 0) + len(merged),
+            'created_at': (stored or {}).get('created_at', now),
+            'updated_at': now
+        }
+        try:
+            self.profile_store.save(record)
+        except Exception as e:
+            storage_logger.exception("保存用户画像错误")
+        return profile, True
+
+    def prompt_lines(self, messages, budget=None):
+        """按配置把消息压缩为提示词中的行"""
+        return compact_message_lines(
+            messages, budget, self.prompt_max_message_chars, self.prompt_name_max_chars,
+            self.prompt_dedup_minutes, self.prompt_merge_minutes)
+
+    async def summarize_messages(self, messages, prompt_type="daily", stats_text='', on_delta=None):
+        """使用AI总结消息
+
+        stats_text 为附在记录之后的活跃统计; 指定 on_delta 时流式生成, 每收到一段文本调用一次。
+        """
+        started = time.perf_counter()
         try:
             if not messages:
                 return "没有找到需要总结的消息"
                 
             # 构建提示词
             if prompt_type == "daily":
-                system_prompt = """你是一个群聊分析助手，负责总结群聊内容。请按以下要求输出：
-1. 不要使用markdown语法
-2. 使用适当的emoji表情
-3. 分段输出，每段之间空一行
-4. 按以下结构深入分析内容：
+                system_prompt = DAILY_SYSTEM_PROMPT
 
-📋 今日话题概述
-- 详细列举主要讨论话题
-- 分析话题的发展脉络
-- 总结核心议题走向
+                user_prompt = "请深入分析以下群聊记录:\n\n"
+            else:  # user_profile
+                system_prompt = PROFILE_SYSTEM_PROMPT
 
-💡 重点讨论内容
-- 深入分析各话题的讨论要点
-- 总结群成员的主要观点分布
-- 提炼有价值的信息亮点
+                user_prompt = "请深入分析该用户的特征:\n\n"
+                
+            # 构建消息历史, 压缩重复消息后按预算保留最新的部分
+            user_prompt += ''.join(self.prompt_lines(messages, self.summary_prompt_tokens))
+            if stats_text:
+                user_prompt += ACTIVITY_STATS_PROMPT.format(stats=stats_text)
+            
+            llm_logger.debug("AI提示词: %s", user_prompt)
+            
+            content = await self.call_llm(system_prompt, user_prompt, on_delta=on_delta)
+            return content or LLM_FAILED_REPLY
+            
+        except Exception as e:
+            llm_logger.exception("AI总结错误")
+            return SUMMARY_ERROR_REPLY
+        finally:
+            SUMMARIZE_SECONDS.observe(time.perf_counter() - started, prompt_type=prompt_type)
 
-🌈 群聊氛围分析
-- 整体情感倾向分析
-- 互动热度和活跃度评估
-- 群组文化特征观察
-- 特殊事件或话题影响
+    async def get_messages_range(self, group_id, start_date, end_date, sender_id=None):
+        """读取某群在日期范围(含两端)内的全部消息, 各天的文件并行扫描"""
+        started = time.perf_counter()
+        if start_date <= self.log_date <= end_date:
+            await self.ingest_writer.flush()
+        messages = await self.message_store.read_range(start_date, end_date, group_id, sender_id)
+        observe_history_read('messages_range', 'store', len(messages), started)
+        return messages
 
-👥 成员互动特点
-- 成员参与度分布
-- 互动模式和规律
-- 意见领袖表现
-- 群体凝聚力表现
+    async def summarize_group(self, group_id, date=None, day_messages=None, days=1, on_delta=None):
+        """总结某个群某天(默认今天)的聊天, 根据 summary_mode 选择一次总结或分块总结
 
-请确保：
-- 每个部分都有充分详实的内容
-- 分析要有深度和洞察
-- 语言自然流畅
-- 结构清晰易读"""
+        day_messages 为已经读取好的该群当天全部消息, 不传时从存储读取;
+        days 大于1时总结截至 date 的最近几天; on_delta 用于流式接收最终总结。
+        """
+        date = date or self.log_date
+        if days > 1:
+            start_date = (datetime.strptime(date, '%Y%m%d') - timedelta(days=days - 1)).strftime('%Y%m%d')
+            messages = await self.get_messages_range(group_id, start_date, date)
+            logger.info("群 %s 在 %s-%s 共有 %d 条消息", group_id, start_date, date, len(messages))
+            stats_text = await self.activity_stats_text(group_id, start_date, date)
+            if self.summary_mode != 'map_reduce':
+                return await self.summarize_messages(
+                    messages[-self.summary_recent_messages:], stats_text=stats_text, on_delta=on_delta)
+            return await self.summarize_map_reduce(
+                messages, period=f"最近{days}天", stats_text=stats_text, on_delta=on_delta)
 
-                user_prompt = "请深入分析以下群聊记录:\n\n"
-            else:  # user_profile
-                system_prompt = """你是一个群聊分析助手，负责分析用户画像。请按以下要求输出：
-1. 不要使用markdown语法
-2. 使用适当的emoji表情
-3. 分段输出，每段之间空一行
-4. 按以下结构深入分析用户特征：
+        # 一次总结只使用预算内最新的消息, 活跃统计覆盖全天
+        stats_text = await self.activity_stats_text(group_id, date, date)
+        if self.summary_mode != 'map_reduce':
+            if date == self.log_date:
+                messages = await self.get_chat_history(group_id, self.summary_recent_messages)
+            else:
+                messages = await self.message_store.latest(date, self.summary_recent_messages, group_id)
+            return await self.summarize_messages(messages, stats_text=stats_text, on_delta=on_delta)
 
-🧠 思维特征分析
-- 思维方式和逻辑特点
-- 观点形成和表达方式
-- 问题解决倾向
-- 认知风格特点
+        messages = day_messages
+        if messages is None:
+            started = time.perf_counter()
+            if date == self.log_date:
+                await self.ingest_writer.flush()
+            messages = await self.message_store.read_day(date, group_id)
+            observe_history_read('group_day', 'store', len(messages), started)
+        logger.info("群 %s 在 %s 共有 %d 条消息", group_id, date, len(messages))
+        return await self.summarize_map_reduce(messages, group_id, date, stats_text=stats_text, on_delta=on_delta)
 
-💭 性格特征画像
-- 性格特点全面分析
-- 情感表达特征
-- 核心价值观表现
-- 行为模式特点
+    async def summarize_map_reduce(self, messages, group_id=None, date=None, period="全天", stats_text='',
+                                   on_delta=None):
+        """分块总结: 按时间窗口把消息分块, 并发提炼要点, 再逐层合并为最终总结
 
-💬 表达风格特征
-- 语言表达特点
-- 用词和表达习惯
-- 情感表达方式
-- 沟通策略分析
+        相邻的时间窗口合并为不超过 summary_chunk_tokens 的块, 提炼要点的请求数不超过
+        summary_max_chunks。指定 group_id 和 date 时各块的要点按块内容的哈希缓存,
+        再次总结时只有新增或发生变化(如迟到的消息)的块需要重新请求大模型。
+        """
+        try:
+            if not messages:
+                return "没有找到需要总结的消息"
 
-🎯 兴趣和专业领域
-- 主要关注话题
-- 专业知识领域
-- 兴趣爱好表现
-- 观点倾向分析
+            lines = self.prompt_lines(messages)
+            total_chunks = len(split_into_chunks(lines, self.summary_chunk_tokens))
+            if total_chunks == 1:
+                return await self.summarize_messages(messages, stats_text=stats_text, on_delta=on_delta)
 
-🤝 社交互动模式
-- 群内角色定位
-- 社交风格特点
-- 互动习惯分析
-- 人际关系处理
+            windows = self.split_into_windows(messages)
+            chunks = self.pack_windows(windows)
+            sampled = False
+            if len(chunks) > self.summary_max_chunks:
+                # 块数超过上限时在各时间窗口内均匀抽样, 控制总成本; 每个窗口的上限固定,
+                # 已结束窗口的抽样结果不随全天消息增多而变化, 缓存仍然有效
+                windows_per_day = max(1, 1440 // self.summary_window_minutes)
+                window_tokens = (self.summary_max_chunks * self.summary_chunk_tokens
+                                 // max(windows_per_day, len(windows)))
+                while True:
+                    windows = self.split_into_windows(messages, max(1, window_tokens))
+                    chunks = self.pack_windows(windows)
+                    if len(chunks) <= self.summary_max_chunks or window_tokens <= 1:
+                        break
+                    # 合并时的空隙使块数仍然超出时, 按超出的比例继续收紧窗口上限
+                    window_tokens = min(window_tokens - 1,
+                                        window_tokens * self.summary_max_chunks // len(chunks))
+                sampled = True
+                if len(chunks) > self.summary_max_chunks:
+                    step = -(-len(chunks) // self.summary_max_chunks)
+                    chunks = chunks[::step]
 
-请确保：
-- 分析要全面且深入
-- 举例说明具体表现
-- 注意分析的逻辑性
-- 保持客观专业态度"""
+            cache = self.load_window_cache(group_id, date) if group_id else {}
+            new_cache = {}
+            semaphore = asyncio.Semaphore(self.summary_map_concurrency)
 
-                user_prompt = "请深入分析该用户的特征:\n\n"
-                
-            # 构建消息历史
-            for msg in messages:
-                user_prompt += f"[{msg.get('timestamp', '未知时间')}] {msg.get('sender_name', '未知用户')}: {msg['text_message']}\n"
-            
-            print(f"AI提示词: {user_prompt}")
-            
-            # 构建请求消息
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-
-            # 创建异步OpenAI客户端
-            client = openai.AsyncOpenAI(
-                base_url="YOUR_API_BASE_URL",
-                api_key="YOUR_API_KEY"
+            async def summarize_chunk(chunk):
+                digest = self.window_digest(chunk)
+                if digest in cache:
+                    new_cache[digest] = cache[digest]
+                    return cache[digest], True
+                async with semaphore:
+                    user_prompt = CHUNK_USER_PROMPT + ''.join(chunk)
+                    partial = await self.call_llm(CHUNK_SYSTEM_PROMPT, user_prompt,
+                                                  self.summary_partial_max_tokens)
+                # 失败的块不缓存, 下次重新总结
+                if partial:
+                    new_cache[digest] = partial
+                return partial, False
+
+            results = await asyncio.gather(*(summarize_chunk(chunk) for chunk in chunks))
+            hits = sum(1 for _, hit in results if hit)
+            logger.info("分块总结: %d 条消息分为 %d 个时间窗口, 合并为 %d 块, %d 块命中缓存%s",
+                        len(messages), len(windows), len(chunks), hits, ', 已在窗口内抽样' if sampled else '')
+            if group_id:
+                self.save_window_cache(group_id, date, new_cache)
+
+            partials = [partial for partial, _ in results if partial]
+            if not partials:
+                return LLM_FAILED_REPLY
+
+            # 片段要点过多时分组合并, 直到一次请求能放下
+            while len(partials) > self.summary_reduce_fanin:
+                groups = [partials[i:i + self.summary_reduce_fanin]
+                          for i in range(0, len(partials), self.summary_reduce_fanin)]
+
+                async def merge(group):
+                    async with semaphore:
+                        user_prompt = "请合并以下按时间顺序排列的群聊要点:\n\n" + '\n\n'.join(group)
+                        return await self.call_llm(MERGE_SYSTEM_PROMPT, user_prompt,
+                                                   self.summary_partial_max_tokens)
+
+                merged = await asyncio.gather(*(merge(group) for group in groups))
+                partials = [partial for partial in merged if partial]
+                if not partials:
+                    return LLM_FAILED_REPLY
+
+            user_prompt = "以下是按时间顺序排列的各时段群聊要点"
+            if sampled:
+                user_prompt += "(消息量较大, 各时段为抽样记录)"
+            user_prompt += f", 请据此深入分析{period}的群聊:\n\n"
+            user_prompt += '\n\n'.join(
+                f"【第{index}段】\n{partial}" for index, partial in enumerate(partials, 1))
+            if stats_text:
+                user_prompt += '\n' + ACTIVITY_STATS_PROMPT.format(stats=stats_text)
+            content = await self.call_llm(DAILY_SYSTEM_PROMPT, user_prompt, on_delta=on_delta)
+            return content or LLM_FAILED_REPLY
+
+        except Exception as e:
+            llm_logger.exception("AI分块总结错误")
+            return SUMMARY_ERROR_REPLY
+
+    def split_into_windows(self, messages, max_tokens=None):
+        """按固定时长把消息分到时间窗口, 返回 [(窗口起始日期时间, 压缩后的行, 是否抽样)]
+
+        指定 max_tokens 时, 超出的窗口按自身的消息量均匀抽样, 只取决于窗口内的消息。
+        """
+        windows = OrderedDict()
+        size = self.summary_window_minutes
+        for msg in messages:
+            timestamp = msg.get('timestamp', '')
+            try:
+                minutes = int(timestamp[11:13]) * 60 + int(timestamp[14:16])
+            except ValueError:
+                minutes = 0
+            start = minutes // size * size
+            key = f"{timestamp[:10]} {start // 60:02d}:{start % 60:02d}"
+            windows.setdefault(key, []).append(msg)
+        # 每个窗口单独压缩, 新消息不会改变之前窗口的内容和缓存
+        result = []
+        for key, window_messages in windows.items():
+            lines = self.prompt_lines(window_messages)
+            sampled = False
+            if max_tokens:
+                tokens = sum(estimate_tokens(line) for line in lines)
+                if tokens > max_tokens:
+                    step = -(-tokens // max_tokens)
+                    lines = self.prompt_lines(window_messages[::step])
+                    sampled = True
+            result.append((key, lines, sampled))
+        return result
+
+    def pack_windows(self, windows):
+        """把相邻的时间窗口合并为不超过 summary_chunk_tokens 的块, 返回 [块内的行]
+
+        超出预算的单个窗口单独切分为多块。块的划分只取决于之前的窗口, 新消息只影响最后几块;
+        窗口跨天时在每块开头和日期变化处插入日期行。
+        """
+        multi_day = len({key[:10] for key, _, _ in windows}) > 1
+        chunks = []
+        current = []
+        current_tokens = 0
+        last_date = None
+        for key, lines, _ in windows:
+            tokens = sum(estimate_tokens(line) for line in lines)
+            if current and current_tokens + tokens > self.summary_chunk_tokens:
+                chunks.append(current)
+                current = []
+                current_tokens = 0
+                last_date = None
+            if multi_day and key[:10] != last_date:
+                header = f"== {key[:10]} ==\n"
+                lines = [header] + lines
+                tokens += estimate_tokens(header)
+                last_date = key[:10]
+            if tokens > self.summary_chunk_tokens:
+                chunks.extend(split_into_chunks(lines, self.summary_chunk_tokens))
+                last_date = None
+                continue
+            current.extend(lines)
+            current_tokens += tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def window_digest(self, lines):
+        """计算一块消息的哈希, 模型、提示词和分块参数变化时也会使缓存失效"""
+        digest = hashlib.sha1()
+        digest.update(f"{WINDOW_CACHE_VERSION}|{self.llm_model}\n".encode('utf-8'))
+        digest.update(CHUNK_SYSTEM_PROMPT.encode('utf-8'))
+        digest.update(CHUNK_USER_PROMPT.encode('utf-8'))
+        digest.update(f"{self.summary_chunk_tokens}|{self.summary_partial_max_tokens}".encode('utf-8'))
+        for line in lines:
+            digest.update(line.encode('utf-8'))
+        return digest.hexdigest()
+
+    def window_cache_path(self, group_id, date):
+        return os.path.join(self.summary_cache_dir, date, f"{quote(str(group_id), safe='')}.json")
+
+    def load_window_cache(self, group_id, date):
+        """读取某群某天各块的要点缓存"""
+        path = self.window_cache_path(group_id, date)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            storage_logger.exception("读取总结缓存错误")
+            return {}
+
+    def save_window_cache(self, group_id, date, cache):
+        """保存某群某天各块的要点缓存"""
+        try:
+            path = self.window_cache_path(group_id, date)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            storage_logger.exception("保存总结缓存错误")
+
+    def cleanup_window_cache(self):
+        """删除超过保留天数的要点缓存"""
+        if not os.path.isdir(self.summary_cache_dir):
+            return
+        oldest = (datetime.now() - timedelta(days=self.summary_cache_days)).strftime("%Y%m%d")
+        for date in os.listdir(self.summary_cache_dir):
+            if date < oldest:
+                shutil.rmtree(os.path.join(self.summary_cache_dir, date), ignore_errors=True)
+
+    def get_llm_client(self):
+        """获取复用的大模型客户端"""
+        if self.llm_client is None:
+            # 重试由 call_llm 统一处理
+            self.llm_client = openai.AsyncOpenAI(
+                base_url=self.llm_base_url,
+                api_key=self.llm_api_key,
+                max_retries=0
             )
+        return self.llm_client
 
-            # 添加重试机制
-            max_retries = 3
-            retry_delay = 1
-            
-            for attempt in range(max_retries):
-                try:
+    def get_http_session(self):
+        """获取复用的HTTP会话"""
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.feishu_timeout))
+        return self.http_session
+
+    async def close_clients(self):
+        """关闭复用的大模型客户端和HTTP会话"""
+        if self.llm_client is not None:
+            await self.llm_client.close()
+            self.llm_client = None
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    async def call_llm(self, system_prompt, user_prompt, max_tokens=None, on_delta=None):
+        """调用大模型, 受限流控制, 失败时按指数退避加随机抖动重试, 全部失败返回None
+
+        指定 on_delta 时使用流式接口, 每收到一段文本调用一次(协程函数)。
+        已经输出过内容后出错时不再重试, 返回已经生成的部分。
+        """
+        max_tokens = max_tokens or self.llm_max_tokens
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + max_tokens
+        client = self.get_llm_client()
+        max_retries = self.llm_max_retries
+
+        for attempt in range(max_retries):
+            if attempt:
+                LLM_RETRIES.inc()
+            started = time.perf_counter()
+            try:
+                await self.llm_limiter.acquire(tokens)
+                started = time.perf_counter()
+                if on_delta is not None:
+                    content = await self.stream_llm(client, messages, max_tokens, on_delta)
+                else:
                     response = await client.chat.completions.create(
-                        model="gemini-2.0-flash",
+                        model=self.llm_model,
                         messages=messages,
                         temperature=0.7,
-                        max_tokens=2000  # 增加token限制以允许更长回复
+                        max_tokens=max_tokens
                     )
-                    
+                    usage = getattr(response, 'usage', None)
+                    if usage is not None:
+                        LLM_TOKENS.inc(usage.prompt_tokens or 0, type='prompt')
+                        LLM_TOKENS.inc(usage.completion_tokens or 0, type='completion')
+                    content = None
                     if response and response.choices and response.choices[0].message:
-                        return response.choices[0].message.content
-                        
-                    print(f"API返回无效响应,重试中({attempt + 1}/{max_retries})")
-                    
-                except Exception as e:
-                    print(f"API调用出错: {traceback.format_exc()}")
-                    print(f"重试中({attempt + 1}/{max_retries})")
-                    
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(retry_delay)
+                        content = response.choices[0].message.content
+                
+                if content:
+                    LLM_SECONDS.observe(time.perf_counter() - started, status='success')
+                    LLM_REQUESTS.inc(status='success')
+                    return content
                     
-            return "AI未能生成有效响应,请稍后重试"
-            
+                LLM_SECONDS.observe(time.perf_counter() - started, status='invalid')
+                llm_logger.warning("API返回无效响应,重试中(%d/%d)", attempt + 1, max_retries)
+                
+            except PartialCompletionError as e:
+                LLM_SECONDS.observe(time.perf_counter() - started, status='error')
+                LLM_REQUESTS.inc(status='partial')
+                llm_logger.warning("流式输出中断, 返回已生成的 %d 字", len(e.content), exc_info=True)
+                return e.content
+            except Exception as e:
+                LLM_SECONDS.observe(time.perf_counter() - started, status='error')
+                llm_logger.warning("API调用出错, 重试中(%d/%d)", attempt + 1, max_retries, exc_info=True)
+                
+            if attempt < max_retries - 1:
+                delay = min(self.llm_retry_max_delay, self.llm_retry_base_delay * 2 ** attempt)
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+                
+        LLM_REQUESTS.inc(status='failed')
+        return None
+
+    async def stream_llm(self, client, messages, max_tokens, on_delta):
+        """流式调用大模型, 返回完整内容; 输出过内容后出错时抛出 PartialCompletionError"""
+        stream = await client.chat.completions.create(
+            model=self.llm_model,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        parts = []
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, 'usage', None)
+                if usage is not None:
+                    LLM_TOKENS.inc(usage.prompt_tokens or 0, type='prompt')
+                    LLM_TOKENS.inc(usage.completion_tokens or 0, type='completion')
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    await on_delta(delta)
         except Exception as e:
-            print(f"AI总结错误: {traceback.format_exc()}")
-            return "AI总结过程中发生错误"
+            if parts:
+                raise PartialCompletionError(''.join(parts)) from e
+            raise
+        return ''.join(parts)
 
     async def daily_summary(self):
-        """执行每日总结"""
+        """执行每日总结, 多个群并发处理"""
         try:
-            print("开始执行每日总结")
+            logger.info("开始执行每日总结")
+            started = time.monotonic()
+            
+            # 先写入缓冲区中的消息
+            await self.ingest_writer.flush()
             
             # 获取所有群组
-            groups = set()
-            if os.path.exists(self.daily_log_path):
-                async with aiofiles.open(self.daily_log_path, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    for row in csv.DictReader(content.splitlines()):
-                        groups.add(row['group_id'])
+            groups = [group['group_id'] for group in await self.get_groups(self.log_date)]
             
-            print(f"发现 {len(groups)} 个群")
+            logger.info("发现 %d 个群", len(groups))
+            
+            # 分块总结需要全天消息, 一次读取后按群分组, 避免每个群各扫描一遍
+            day_messages = {}
+            if self.summary_mode == 'map_reduce':
+                read_started = time.perf_counter()
+                rows = await self.message_store.read_day(self.log_date)
+                for row in rows:
+                    day_messages.setdefault(row['group_id'], []).append(row)
+                observe_history_read('daily', 'store', len(rows), read_started)
             
             # 为每个群生成总结
-            for group_id in groups:
-                messages = await self.get_chat_history(group_id)
-                if messages:
-                    summary = await self.summarize_messages(messages)
-                    # 保存自动总结
+            semaphore = asyncio.Semaphore(self.summary_concurrency)
+            timings = {}
+            
+            async def summarize_group(group_id):
+                async with semaphore:
+                    group_started = time.monotonic()
+                    summary = await self.summarize_group(
+                        group_id, day_messages=day_messages.pop(group_id, None))
+                    # 保存自动总结, 放入发件箱等待推送到飞书
                     await self.save_summary(group_id, summary, 'auto')
-                    
-                    # 构造飞书webhook消息
-                    webhook_url = "YOUR_FEISHU_WEBHOOK_URL"
-                    webhook_data = {
-                        "msg_type": "text",
-                        "content": {
-                            "text": f"群 {group_id} 的每日总结:\n{summary}"
-                        }
-                    }
-                    
-                    # 发送webhook请求
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(webhook_url, json=webhook_data) as resp:
-                            if resp.status == 200:
-                                print(f"已发送群 {group_id} 的每日总结到飞书")
-                            else:
-                                print(f"发送群 {group_id} 的每日总结到飞书失败: {await resp.text()}")
+                    self.feishu_outbox.put(f"群 {group_id} 的每日总结", summary)
+                    timings[group_id] = time.monotonic() - group_started
+            
+            results = await asyncio.gather(
+                *(summarize_group(group_id) for group_id in groups), return_exceptions=True)
+            # 全部群已经生成完毕, 剩余的通知不必再等待凑满一批
+            self.feishu_outbox.send_now()
+            
+            failed = 0
+            for group_id, result in zip(groups, results):
+                if isinstance(result, Exception):
+                    failed += 1
+                    logger.error("群 %s 的每日总结出错", group_id, exc_info=result)
+            
+            elapsed = time.monotonic() - started
+            self.last_daily_run = {
+                'date': self.log_date,
+                'groups': len(groups),
+                'failed': failed,
+                'elapsed_seconds': round(elapsed, 2),
+                'max_group_seconds': round(max(timings.values()), 2) if timings else 0,
+                'avg_group_seconds': round(sum(timings.values()) / len(timings), 2) if timings else 0
+            }
+            logger.info("每日总结完成: %s", self.last_daily_run)
 
         except Exception as e:
-            print(f"每日总结错误: {traceback.format_exc()}")
+            logger.exception("每日总结错误")
+
+    async def post_feishu(self, payload):
+        """向飞书webhook发送一条消息, 返回 (是否成功, 被限流时需要暂停的秒数)"""
+        await self.feishu_limiter.acquire()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async with self.get_http_session().post(self.feishu_webhook_url, json=payload) as resp:
+                text = await resp.text()
+                try:
+                    body = json.loads(text)
+                except ValueError:
+                    body = {}
+                if not isinstance(body, dict):
+                    body = {}
+                # 新版接口返回 code, 旧版返回 StatusCode, 0 表示成功
+                code = body.get('code', body.get('StatusCode', 0))
+                if resp.status == 200 and code == 0:
+                    status = 'success'
+                    logger.info("已推送到飞书: %s", payload.get('msg_type'))
+                    return True, 0
+                if resp.status == 429 or code == FEISHU_RATE_LIMITED_CODE:
+                    status = 'rate_limited'
+                    try:
+                        pause = float(resp.headers.get('Retry-After', ''))
+                    except ValueError:
+                        pause = self.feishu_rate_limit_pause
+                    return False, max(pause, 1)
+                status = 'failed'
+                logger.error("推送到飞书失败: HTTP %s %s", resp.status, text)
+        except Exception as e:
+            logger.exception("推送到飞书出错")
+        finally:
+            FEISHU_SECONDS.observe(time.perf_counter() - started)
+            FEISHU_POSTS.inc(status=status)
+        return False, 0
+
+    def command_key(self, group_id, *args):
+        """群聊命令结果的缓存键: 群号、命令参数、日志日期和该群的数据版本号"""
+        return (group_id, *args, self.log_date, self.group_versions.get(group_id, 0))
 
     @handler(GroupNormalMessageReceived)
     async def on_group_message(self, ctx: EventContext):
@@ -338,13 +3983,17 @@ class ChatAnalyzerPlugin(BasePlugin):
             # 立即阻止默认行为
             ctx.prevent_default()
             
+            # 等待消息存储准备完成(导入CSV记录、预热缓存)
+            await self.store_ready.wait()
+            
             # 获取消息信息
             timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            group_id = getattr(ctx.event, 'launcher_id', '')
-            sender_id = getattr(ctx.event, 'sender_id', '')
+            group_id = str(getattr(ctx.event, 'launcher_id', ''))
+            sender_id = str(getattr(ctx.event, 'sender_id', ''))
             text = getattr(ctx.event, 'text_message', '')
+            group_name, sender_name = self.get_display_names(ctx)
             
-            print(f"收到群消息: {timestamp} | 群:{group_id} | 发送者:{sender_id} | 内容:{text}")
+            ingest_logger.info("收到群消息: %s | 群:%s | 发送者:%s | 内容:%s", timestamp, group_id, sender_id, text)
             
             # 处理!开头的命令
             if text.startswith('!'):
@@ -353,38 +4002,62 @@ class ChatAnalyzerPlugin(BasePlugin):
                     return
                     
             # 处理其他命令
-            if text == '总结':
-                print("收到总结命令")
-                # 获取群历史消息
-                messages = await self.get_chat_history(group_id)
-                print(f"获取到 {len(messages)} 条历史消息")
-                # 生成总结
-                summary = await self.summarize_messages(messages)
-                print(f"生成总结: {summary}")
-                # 保存总结
-                await self.save_summary(group_id, summary, 'manual')
-                # 发送总结
-                await ctx.reply(MessageChain([Plain(f"【群聊总结】\n{summary}")]))
+            summary_match = re.fullmatch(r'总结(?:\s*(\d+)\s*天?)?', text)
+            if summary_match:
+                logger.info("收到总结命令")
+                # "总结 N" 总结最近N天
+                days = min(max(int(summary_match.group(1) or 1), 1), self.summary_max_days)
+                
+                # 边生成边按段落回复; 合并到其他请求或命中缓存时一次回复完整结果
+                sender = ReplySectionSender(
+                    lambda text: ctx.reply(MessageChain([Plain(text)])), "【群聊总结】",
+                    self.reply_section_min_chars)
+                
+                async def compute_summary():
+                    # 生成总结
+                    summary = await self.summarize_group(
+                        group_id, days=days, on_delta=sender.feed if self.summary_stream_reply else None)
+                    logger.debug("生成总结: %s", summary)
+                    # 保存总结
+                    await self.save_summary(group_id, summary, 'manual')
+                    return summary
+                
+                # 相同群、相同数据版本的并发请求只计算一次
+                summary, source = await self.command_cache.run(
+                    self.command_key(group_id, '总结', days),
+                    compute_summary, is_cacheable_reply)
+                if source != 'computed':
+                    logger.info("总结命令使用%s的结果", '缓存' if source == 'cache' else '并发合并')
+                # 发送总结(流式回复时只发送剩余部分)
+                await sender.finish(summary)
                 return
                 
             elif text.startswith('看看'):
-                print("收到看看命令")
+                logger.info("收到看看命令")
                 # 解析用户ID
                 user_id = text.split(' ')[1] if len(text.split(' ')) > 1 else sender_id
-                print(f"目标用户ID: {user_id}")
-                # 获取用户消息
-                messages = await self.get_user_messages(group_id, user_id)
-                print(f"获取到 {len(messages)} 条用户消息")
-                # 生成画像
-                profile = await self.summarize_messages(messages, "user_profile")
-                print(f"生成画像: {profile}")
-                # 保存总结
-                await self.save_summary(group_id, profile, 'manual')
+                logger.debug("目标用户ID: %s", user_id)
+                
+                async def compute_profile():
+                    # 生成或增量更新画像
+                    profile, updated = await self.build_user_profile(group_id, user_id)
+                    logger.debug("生成画像: %s", profile)
+                    # 保存总结
+                    if updated:
+                        await self.save_summary(group_id, profile, 'profile')
+                    return profile
+                
+                profile, source = await self.command_cache.run(
+                    self.command_key(group_id, '看看', user_id),
+                    compute_profile, is_cacheable_reply)
+                if source != 'computed':
+                    logger.info("看看命令使用%s的结果", '缓存' if source == 'cache' else '并发合并')
                 # 发送画像
                 await ctx.reply(MessageChain([Plain(f"【用户画像】\n{profile}")]))
                 return
                 
             # 记录消息
+            ingest_started = time.perf_counter()
             raw_data = {
                 'timestamp': timestamp,
                 'group_id': group_id,
@@ -392,28 +4065,55 @@ class ChatAnalyzerPlugin(BasePlugin):
                 'text': text
             }
             
-            # 写入CSV
-            async with aiofiles.open(self.daily_log_path, 'a', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                await writer.writerow([
-                    timestamp,
-                    group_id,
-                    '',  # group_name
-                    sender_id,
-                    '',  # sender_name
-                    text,
-                    json.dumps(raw_data, ensure_ascii=False)
-                ])
+            # 加入批量写入队列
+            await self.ingest_writer.put([
+                timestamp,
+                group_id,
+                group_name,
+                sender_id,
+                sender_name,
+                text,
+                json.dumps(raw_data, ensure_ascii=False)
+            ])
+            row = {
+                'timestamp': timestamp,
+                'group_id': group_id,
+                'group_name': group_name,
+                'sender_id': sender_id,
+                'sender_name': sender_name,
+                'text_message': text
+            }
+            self.recent_cache.add(row)
+            self.group_catalog.record(row)
+            self.activity_stats.record(row)
+            self.search_index.add(row)
+            self.message_broadcaster.publish(row)
+            # 新消息使该群的命令结果缓存失效
+            self.group_versions[group_id] = self.group_versions.get(group_id, 0) + 1
+            self.command_cache.invalidate_group(group_id)
+            INGEST_MESSAGES.inc()
+            INGEST_SECONDS.observe(time.perf_counter() - ingest_started)
                 
         except Exception as e:
-            print(f"处理消息错误: {traceback.format_exc()}")
+            ingest_logger.exception("处理消息错误")
+
+    def get_display_names(self, ctx):
+        """从事件中取出群名称和发送者昵称, 平台不提供时返回空字符串"""
+        try:
+            sender = ctx.event.query.message_event.sender
+        except AttributeError:
+            return '', ''
+        group = getattr(sender, 'group', None)
+        group_name = getattr(group, 'name', '') or ''
+        sender_name = getattr(sender, 'member_name', '') or ''
+        return str(group_name), str(sender_name)
 
     # === Web服务相关代码开始 ===
     
     async def start_web_server(self):
         """启动Web服务器"""
         try:
-            print("开始配置Web服务器...")
+            web_logger.info("开始配置Web服务器...")
             
             # 创建中间件来处理认证
             @web.middleware
@@ -429,7 +4129,7 @@ class ChatAnalyzerPlugin(BasePlugin):
                     # 解码认证信息
                     auth_decoded = base64.b64decode(auth.split()[1]).decode('utf-8')
                     username, password = auth_decoded.split(':')
-                    if password != "YOUR_PASSWORD":  # 设置密码
+                    if password != self.web_password:
                         raise ValueError("密码错误")
                 except:
                     # 认证失败，返回401
@@ -439,89 +4139,522 @@ class ChatAnalyzerPlugin(BasePlugin):
                 # 认证成功，继续处理请求
                 return await handler(request)
             
-            app = web.Application(middlewares=[auth_middleware])
+            # 记录每个接口的请求次数和耗时, 认证失败的请求也计入
+            @web.middleware
+            async def metrics_middleware(request, handler):
+                resource = request.match_info.route.resource
+                name = resource.canonical if resource is not None else 'unmatched'
+                started = time.perf_counter()
+                status = 500
+                try:
+                    response = await handler(request)
+                    status = response.status
+                    return response
+                except web.HTTPException as e:
+                    status = e.status
+                    raise
+                finally:
+                    HTTP_SECONDS.observe(time.perf_counter() - started, handler=name)
+                    HTTP_REQUESTS.inc(handler=name, status=status)
+            
+            # 压缩尚未发送的完整响应, 流式响应由各自的处理函数决定
+            @web.middleware
+            async def compression_middleware(request, handler):
+                response = await handler(request)
+                if isinstance(response, web.Response) and not response.prepared:
+                    await self.compress_response(request, response)
+                return response
+            
+            app = web.Application(middlewares=[metrics_middleware, auth_middleware, compression_middleware])
             app.router.add_get('/', self.handle_index)
             app.router.add_get('/messages', self.handle_messages)
+            app.router.add_get('/messages/stream', self.handle_message_stream)
             app.router.add_get('/summaries', self.handle_summaries)
+            app.router.add_get('/export', self.handle_export)
+            app.router.add_get('/export/summaries', self.handle_export_summaries)
+            app.router.add_get('/groups', self.handle_groups)
+            app.router.add_get('/profiles', self.handle_profiles)
+            app.router.add_get('/status', self.handle_status)
+            app.router.add_get('/metrics', self.handle_metrics)
+            app.router.add_get('/search', self.handle_search)
+            app.router.add_get('/stats', self.handle_stats)
             
             static_path = os.path.join(os.path.dirname(__file__), 'static')
             app.router.add_static('/static', static_path)
-            print(f"静态文件路径配置为: {static_path}")
+            web_logger.info("静态文件路径配置为: %s", static_path)
             
             runner = web.AppRunner(app)
             await runner.setup()
-            site = web.TCPSite(runner, '0.0.0.0', 3300)  # 使用3300端口
+            self.web_runner = runner
+            site = web.TCPSite(runner, '0.0.0.0', self.web_port)
             await site.start()
-            print("Web服务器已成功启动在 http://0.0.0.0:3300")
+            web_logger.info("Web服务器已成功启动在 http://0.0.0.0:%d", self.web_port)
         except Exception as e:
-            print(f"启动Web服务器时发生错误: {traceback.format_exc()}")
+            web_logger.exception("启动Web服务器时发生错误")
+
+    def cache_headers(self, request, version, last_modified):
+        """根据数据版本生成缓存相关的响应头
+
+        返回 (响应头, 客户端缓存是否仍然有效)。ETag 由请求地址和数据版本计算,
+        压缩后的响应内容不同, 所以使用弱 ETag。历史数据也可能变化(迟到的消息并入归档、
+        重新生成总结), 所以浏览器每次都要重新验证, 没有变化时返回 304。
+        """
+        etag = 'W/"%s"' % hashlib.md5(f'{request.path_qs}\n{version}'.encode('utf-8')).hexdigest()
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'private, no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if last_modified:
+            headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # 弱比较: 忽略 W/ 前缀
+            fresh = '*' in tags or etag[2:] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        else:
+            since = request.if_modified_since
+            fresh = bool(last_modified and since and int(last_modified) <= since.timestamp())
+        return headers, fresh
+
+    def accepts_encoding(self, request, coding):
+        return coding in request.headers.get('Accept-Encoding', '').lower()
+
+    async def compress_response(self, request, response):
+        """按 Accept-Encoding 压缩响应体, 安装了 brotli 时优先使用 br, 否则使用 gzip"""
+        body = response.body
+        if (not isinstance(body, bytes) or len(body) < self.web_compress_min_size
+                or 'Content-Encoding' in response.headers
+                or response.content_type not in ('application/json', 'text/csv', 'text/plain', 'text/html')):
+            return
+        response.headers['Vary'] = 'Accept-Encoding'
+        if brotli is not None and self.accepts_encoding(request, 'br'):
+            loop = asyncio.get_event_loop()
+            response.body = await loop.run_in_executor(
+                None, lambda: brotli.compress(body, quality=self.web_brotli_quality))
+            response.headers['Content-Encoding'] = 'br'
+        elif self.accepts_encoding(request, 'gzip'):
+            response.enable_compression(web.ContentCoding.gzip)
 
     async def handle_index(self, request):
         """处理首页请求"""
         try:
             template_path = os.path.join(os.path.dirname(__file__), 'templates', 'index.html')
-            print(f"尝试加载模板: {template_path}")
+            web_logger.debug("尝试加载模板: %s", template_path)
             if not os.path.exists(template_path):
-                print(f"警告: 模板文件不存在: {template_path}")
+                web_logger.warning("模板文件不存在: %s", template_path)
                 return web.Response(text="Template not found", status=404)
             return web.FileResponse(template_path)
         except Exception as e:
-            print(f"处理首页请求时发生错误: {traceback.format_exc()}")
+            web_logger.exception("处理首页请求时发生错误")
             return web.Response(text="Internal Server Error", status=500)
 
     async def handle_messages(self, request):
-        """处理消息列表请求"""
+        """处理消息列表请求
+
+        查询单天(date)或日期范围(from/to, 含两端), 支持 limit/cursor 分页以及
+        before/after 时间过滤, 逐批从存储读取并以流的形式返回
+        {"messages": [...], "next_cursor": ..., "has_more": ...}。
+        """
         try:
             group_id = request.query.get('group_id', '')
             date = request.query.get('date', datetime.now().strftime("%Y%m%d"))
+            start_date = request.query.get('from') or date
+            end_date = request.query.get('to') or start_date
+            limit = max(1, min(int(request.query.get('limit', self.messages_page_size)),
+                               self.messages_max_page_size))
+            before = request.query.get('before') or None
+            after = request.query.get('after') or None
+            for value in (start_date, end_date):
+                check_date(value)
+            # 游标格式为 "日期:存储内位置", 在开始输出之前校验, 出错时才能返回 400
+            cursor = request.query.get('cursor') or None
+            if cursor:
+                self.message_store.check_cursor(cursor)
+        except Exception as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            started = time.perf_counter()
+            # 在写入前记下推送的事件编号, 页面从这里开始接收实时消息, 不会漏掉消息
+            last_event_id = self.message_broadcaster.event_id(self.message_broadcaster.last_id)
+            yesterday = (datetime.strptime(self.log_date, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d')
+            if end_date >= yesterday:
+                # 日期切换前收到的消息可能还在写入队列中
+                await self.ingest_writer.flush()
+            version, last_modified = await self.message_store.version(start_date, end_date)
+            headers, fresh = self.cache_headers(request, version, last_modified)
+            headers['X-Last-Event-Id'] = last_event_id
+            if fresh:
+                return web.Response(status=304, headers=headers)
+            rows = self.message_store.iter_range(
+                start_date, end_date, group_id or None, None, cursor, before, after,
+                chunk_rows=min(limit + 1, self.messages_scan_batch))
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        response = web.StreamResponse(headers=headers)
+        if self.accepts_encoding(request, 'gzip'):
+            response.enable_compression(web.ContentCoding.gzip)
+        await response.prepare(request)
+        try:
+            await response.write(b'{"messages":[')
+            count = 0
+            has_more = False
+            next_cursor = cursor
+            batch = []
+            async for row, position in rows:
+                # 多读到一行说明还有下一页
+                if count == limit:
+                    has_more = True
+                    break
+                batch.append(json.dumps(row, ensure_ascii=False))
+                count += 1
+                next_cursor = position
+                if len(batch) >= self.messages_scan_batch:
+                    await response.write(((',' if count > len(batch) else '') + ','.join(batch)).encode('utf-8'))
+                    batch = []
+            if batch:
+                await response.write(((',' if count > len(batch) else '') + ','.join(batch)).encode('utf-8'))
+            observe_history_read('messages_page', 'store', count, started)
+            tail = {'next_cursor': next_cursor, 'has_more': has_more}
+            await response.write(('],' + json.dumps(tail)[1:]).encode('utf-8'))
+        except Exception as e:
+            # 响应头已经发出, 中断连接而不是正常结束, 避免客户端把不完整的JSON当作完整结果
+            web_logger.exception("处理消息列表请求出错")
+            raise
+        finally:
+            await rows.aclose()
+        await response.write_eof()
+        return response
+
+    async def handle_message_stream(self, request):
+        """以 Server-Sent Events 推送新收到的消息
+
+        可按 group_id 过滤; 重连时浏览器带上 Last-Event-ID(也可用 last_event_id 参数),
+        补发之后的消息。没有新消息时定时发送注释行作为心跳。
+        """
+        broadcaster = self.message_broadcaster
+        if len(broadcaster.subscribers) >= self.web_stream_max_clients:
+            return web.json_response({'error': '实时推送连接数已达上限'}, status=503)
+        group_id = request.query.get('group_id') or None
+        last_event_id = request.headers.get('Last-Event-ID') or request.query.get('last_event_id')
+        subscriber = broadcaster.subscribe(last_event_id)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream; charset=utf-8',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        try:
+            await response.prepare(request)
+            await response.write(b'retry: 3000\n\n')
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.get(), self.web_stream_heartbeat)
+                except asyncio.TimeoutError:
+                    await response.write(b': ping\n\n')
+                    continue
+                # 把队列中已有的消息合并为一次写入
+                events = [event]
+                while event is not None and not subscriber.empty():
+                    event = subscriber.get_nowait()
+                    events.append(event)
+                chunks = []
+                for event in events:
+                    if event is None:
+                        break
+                    number, row = event
+                    if group_id and row['group_id'] != group_id:
+                        continue
+                    chunks.append(f'id: {broadcaster.event_id(number)}\n'
+                                  f'data: {json.dumps(row, ensure_ascii=False)}\n\n')
+                if chunks:
+                    await response.write(''.join(chunks).encode('utf-8'))
+                if events[-1] is None:
+                    break
+        except ConnectionResetError:
+            pass
+        finally:
+            broadcaster.unsubscribe(subscriber)
+        return response
+
+    async def handle_groups(self, request):
+        """处理群目录请求, 不指定日期时返回全部日期的汇总"""
+        try:
+            date = request.query.get('date') or None
+            # 日期会写入群目录并用于拼接文件路径, 先校验格式
+            if date is not None:
+                check_date(date)
+        except ValueError as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            return web.json_response(await self.get_groups(date))
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def handle_profiles(self, request):
+        """处理用户画像请求: 指定 user_id 时返回单个画像, 否则返回该群全部画像"""
+        try:
+            group_id = request.query.get('group_id', '')
+            user_id = request.query.get('user_id', '')
+            if not group_id:
+                return web.json_response({'error': '缺少 group_id 参数'}, status=400)
+            if user_id:
+                profile = self.profile_store.load(group_id, user_id)
+                if profile is None:
+                    return web.json_response({'error': '用户画像不存在'}, status=404)
+                return web.json_response(profile)
+            return web.json_response(self.profile_store.list_group(group_id))
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def handle_export(self, request):
+        """导出某天的消息记录为CSV"""
+        try:
+            group_id = request.query.get('group_id', '')
+            date = request.query.get('date', datetime.now().strftime("%Y%m%d"))
+            check_date(date)
+        except Exception as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            if date == self.log_date:
+                await self.ingest_writer.flush()
+            messages = await self.message_store.read_day(date, group_id or None)
             
-            messages = []
-            log_path = os.path.join(self.data_dir, f'daily_{date}.csv')
-            
-            if os.path.exists(log_path):
-                async with aiofiles.open(log_path, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    for row in csv.DictReader(content.splitlines()):
-                        if not group_id or row['group_id'] == group_id:
-                            messages.append(row)
-            
-            return web.json_response(messages)
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=MESSAGE_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(messages)
+            filename = f"messages_{date}_{group_id or 'all'}.csv"
+            return web.Response(
+                body=buf.getvalue().encode('utf-8-sig'),
+                content_type='text/csv',
+                charset='utf-8',
+                headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+            )
         except Exception as e:
             return web.json_response({'error': str(e)}, status=500)
 
     async def handle_summaries(self, request):
-        """处理总结列表请求"""
+        """处理总结列表请求
+
+        支持按群、类型、日期范围(from/to, YYYYMMDD)过滤, 以及 limit/cursor 分页,
+        返回 {"summaries": [...], "total": ..., "next_cursor": ..., "has_more": ...}。
+        """
         try:
             group_id = request.query.get('group_id', '')
             summary_type = request.query.get('type', '')
-            
-            summaries = []
-            if os.path.exists(self.summary_path):
-                async with aiofiles.open(self.summary_path, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    for row in csv.DictReader(content.splitlines()):
-                        if (not group_id or row['group_id'] == group_id) and \
-                           (not summary_type or row['summary_type'] == summary_type):
-                            summaries.append(row)
-            
-            return web.json_response(summaries)
+            from_date = request.query.get('from') or None
+            to_date = request.query.get('to') or None
+            for value in (from_date, to_date):
+                if value:
+                    check_date(value)
+            cursor = request.query.get('cursor') or None
+            if cursor:
+                self.summary_store.check_cursor(cursor)
+            limit = max(1, min(int(request.query.get('limit', self.summaries_page_size)),
+                               self.summaries_max_page_size))
+        except Exception as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            version, last_modified = self.summary_store.version(from_date, to_date)
+            headers, fresh = self.cache_headers(request, version, last_modified)
+            if fresh:
+                return web.Response(status=304, headers=headers)
+            summaries, total, next_cursor = await self.summary_store.query(
+                group_id, summary_type, from_date, to_date, limit, cursor)
+            return web.json_response({
+                'summaries': summaries,
+                'total': total,
+                'next_cursor': next_cursor,
+                'has_more': next_cursor is not None
+            }, headers=headers)
         except Exception as e:
             return web.json_response({'error': str(e)}, status=500)
 
-    async def save_summary(self, group_id: str, content: str, summary_type: str = 'manual'):
-        """保存总结内容"""
+    async def handle_search(self, request):
+        """处理全文检索请求
+
+        参数 q 为查询词, 可按群和日期范围(from/to, YYYYMMDD, 默认今天)过滤,
+        结果按相关度排序, 支持 limit/cursor 分页, 片段中的命中词用 <mark> 标出。
+        """
         try:
-            async with aiofiles.open(self.summary_path, 'a', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                await writer.writerow([
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    group_id,
-                    summary_type,
-                    content,
-                    datetime.now().strftime('%Y%m%d')
-                ])
-            print(f"已保存{summary_type}总结到文件")
-        except Exception as e:
-            print(f"保存总结错误: {traceback.format_exc()}")
+            query = request.query.get('q', '').strip()
+            if not query:
+                raise ValueError('缺少查询词')
+            group_id = request.query.get('group_id', '')
+            end_date = request.query.get('to') or self.log_date
+            start_date = request.query.get('from') or end_date
+            check_date(start_date)
+            check_date(end_date)
+            if start_date > end_date:
+                raise ValueError('from 晚于 to')
+            days = (datetime.strptime(end_date, '%Y%m%d') - datetime.strptime(start_date, '%Y%m%d')).days + 1
+            if days > self.search_max_days:
+                raise ValueError(f'最多查询 {self.search_max_days} 天')
+            limit = max(1, min(int(request.query.get('limit', self.search_page_size)),
+                               self.search_max_page_size))
+            offset = int(request.query.get('cursor') or 0)
+            if offset < 0:
+                raise ValueError(f'无效的游标: {offset}')
+        except Exception as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            started = time.perf_counter()
+            hits = await self.search_messages(query, group_id or None, start_date, end_date)
+            page = hits[offset:offset + limit]
+            docs = await self.search_index.fetch_docs([(date, doc_id) for _, date, doc_id in page])
+            terms = set(query.split()) | set(tokenize_text(query))
+            results = []
+            for score, date, doc_id in page:
+                doc = docs.get((date, doc_id))
+                if doc is None:
+                    continue
+                message = dict(zip(MESSAGE_COLUMNS, doc))
+                message['date'] = date
+                message['score'] = round(score, 4)
+                message['snippet'] = highlight_snippet(message['text_message'], terms)
+                results.append(message)
+            next_offset = offset + len(page)
+            return web.json_response({
+                'results': results,
+                'total': len(hits),
+                'next_cursor': str(next_offset) if next_offset < len(hits) else None,
+                'has_more': next_offset < len(hits),
+                'took_ms': round((time.perf_counter() - started) * 1000, 2)
+            })
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def handle_stats(self, request):
+        """处理活跃统计请求
+
+        查询单天(date, 默认今天)或日期范围(from/to, 含两端), 可按群(group_id)
+        和成员(user_id)过滤, top 为返回的发言最多成员数。
+        """
+        try:
+            date = request.query.get('date') or self.log_date
+            start_date = request.query.get('from') or date
+            end_date = request.query.get('to') or start_date
+            for value in (date, start_date, end_date):
+                check_date(value)
+            if start_date > end_date:
+                raise ValueError('from 晚于 to')
+            days = (datetime.strptime(end_date, '%Y%m%d') - datetime.strptime(start_date, '%Y%m%d')).days + 1
+            if days > self.stats_max_days:
+                raise ValueError(f'最多查询 {self.stats_max_days} 天')
+            group_id = request.query.get('group_id') or None
+            user_id = request.query.get('user_id') or None
+            top = max(1, min(int(request.query.get('top', self.stats_top_posters)), 100))
+        except Exception as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            report = await self.get_activity_stats(start_date, end_date, group_id, user_id, top)
+            report.update({'from': start_date, 'to': end_date})
+            return web.json_response(report)
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def handle_export_summaries(self, request):
+        """导出满足条件的全部总结为CSV"""
+        try:
+            group_id = request.query.get('group_id', '')
+            summary_type = request.query.get('type', '')
+            from_date = request.query.get('from') or None
+            to_date = request.query.get('to') or None
+            for value in (from_date, to_date):
+                if value:
+                    check_date(value)
+        except Exception as e:
+            return web.json_response({'error': f'参数错误: {e}'}, status=400)
+
+        try:
+            content = await self.summary_store.export(group_id, summary_type, from_date, to_date)
+            filename = f"summaries_{group_id or 'all'}_{summary_type or 'all'}.csv"
+            return web.Response(
+                body=content.encode('utf-8-sig'),
+                content_type='text/csv',
+                charset='utf-8',
+                headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+            )
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def handle_status(self, request):
+        """处理运行状态请求"""
+        try:
+            writer = self.ingest_writer
+            loop = asyncio.get_event_loop()
+            archive = await loop.run_in_executor(None, self.log_archive.stats)
+            archive['last_compaction'] = self.last_compaction
+            return web.json_response({
+                'ingest': {
+                    'queue_depth': writer.depth,
+                    'max_queue_depth': writer.max_depth,
+                    'rows_written': writer.rows_written,
+                    'batches_written': writer.batches_written
+                },
+                'storage': self.message_store.name,
+                'last_daily_run': self.last_daily_run,
+                'feishu_outbox': self.feishu_outbox.stats(),
+                'archive': archive,
+                'recent_cache': {
+                    'date': self.recent_cache.date,
+                    'cached_messages': self.recent_cache.total
+                }
+            })
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def get_data_dir_size(self):
+        """统计数据目录占用的字节数, 结果缓存 metrics_dir_size_interval 秒"""
+        now = time.monotonic()
+        if self.data_dir_size is None or now - self.data_dir_size[0] >= self.metrics_dir_size_interval:
+            def walk():
+                total = 0
+                for root, _, files in os.walk(self.data_dir):
+                    for name in files:
+                        try:
+                            total += os.path.getsize(os.path.join(root, name))
+                        except OSError:
+                            pass
+                return total
+
+            loop = asyncio.get_event_loop()
+            self.data_dir_size = (now, await loop.run_in_executor(None, walk))
+        return self.data_dir_size[1]
+
+    async def handle_metrics(self, request):
+        """以 Prometheus 文本格式输出运行指标"""
+        try:
+            INGEST_QUEUE_DEPTH.set(self.ingest_writer.depth)
+            FEISHU_OUTBOX_DEPTH.set(self.feishu_outbox.depth)
+            TODAY_ROWS.set(sum(group['message_count'] for group in self.group_catalog.groups(self.log_date)))
+            DATA_DIR_BYTES.set(await self.get_data_dir_size())
+            return web.Response(body=METRICS.render().encode('utf-8'),
+                                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+
+    async def save_summary(self, group_id: str, content: str, summary_type: str = 'manual',
+                           source_date: str = None):
+        """保存总结内容, source_date 为被总结消息的日期, 默认为当前日志日期"""
+        try:
+            await self.summary_store.append({
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'group_id': group_id,
+                'summary_type': summary_type,
+                'content': content,
+                'source_date': source_date or self.log_date
+            })
+            storage_logger.info("已保存%s总结到文件", summary_type)
+        except Exception as e:
+            storage_logger.exception("保存总结错误")
 
     # === Web服务相关代码结束 ===